@@ -1,10 +1,30 @@
 import os
+import base64
+import binascii
+import hashlib
+import json
+import re
 import threading
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify
+import uuid
+from datetime import datetime
+from urllib.parse import quote
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, send_file, flash, jsonify, session, stream_with_context
 from werkzeug.utils import secure_filename
+from sqlalchemy import literal, tuple_
+from sqlalchemy.orm import aliased
 from config import Config
-from database import db, File, Folder
-from telegram_service import telegram_service
+from database import db, File, FileChunk, Folder, FolderStats, Thumbnail, UploadJob, prepare_database, upgrade_schema
+if Config.TELEGRAM_GATEWAY:
+    # Several workers: the Telegram client lives in the gateway process
+    from gateway import GatewayClient
+    telegram_service = GatewayClient(Config.TELEGRAM_GATEWAY)
+else:
+    from telegram_service import telegram_service
+from cache import DiskCache
+import compression
+import metrics
+import search
+import zipstream
 import traceback
 import sys
 import time
@@ -16,12 +36,31 @@ app.config.from_object(Config)
 # Initialize Database
 db.init_app(app)
 with app.app_context():
-    db.create_all()
+    if Config.TELEGRAM_GATEWAY:
+        # Under gunicorn the master has prepared the database (gunicorn.conf.py)
+        search.detect()
+    else:
+        prepare_database()
+
+download_cache = DiskCache(Config.CACHE_FOLDER, Config.CACHE_MAX_BYTES, Config.CACHE_MAX_ENTRIES)
+
+def cache_key(file_record):
+    return f"{file_record.chat_id}_{file_record.telegram_id}"
 
 def log_debug(msg):
     print(f"[Web] {msg}")
     sys.stdout.flush()
 
+def browser_id():
+    """Identifies this browser session, so it only sees its own uploads' progress."""
+    if 'browser_id' not in session:
+        session['browser_id'] = uuid.uuid4().hex
+    return session['browser_id']
+
+def attachment_header(filename):
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
 @app.route('/debug_status')
 def debug_status():
     status = {
@@ -33,13 +72,25 @@ def debug_status():
         "SESSION_STRING_LOADED": bool(Config.SESSION_STRING),
         "IS_PYTHONANYWHERE": Config.IS_PYTHONANYWHERE,
         "ENV_KEYS": list(os.environ.keys()),
-        "TELEGRAM_READY": telegram_service.ready_event.is_set(),
-        "THREAD_ALIVE": telegram_service.thread.is_alive() if telegram_service.thread else False,
+        "TELEGRAM_GATEWAY": Config.TELEGRAM_GATEWAY or None,
+        "DOWNLOAD_CACHE": download_cache.stats(),
         "LOG_TAIL": [],
         "UPLOAD_FOLDER": Config.UPLOAD_FOLDER,
         "CWD": os.getcwd(),
         "NETWORK_CHECK": {}
     }
+
+    try:
+        service = telegram_service.get_status()
+        status["TELEGRAM_READY"] = service['ready']
+        status["THREAD_ALIVE"] = service['thread_alive']
+        status["WORKER_POOL"] = service['worker_pool']
+        status["UPLOAD_JOBS"] = service['upload_jobs']
+        status["STORAGE_POLICY"] = service['storage_policy']
+        status["STORAGE_TARGETS"] = service['storage_targets']
+        status["LOG_TAIL"] = service['log_tail']
+    except Exception as e:
+        status["TELEGRAM_STATUS_ERROR"] = str(e)
     
     # Test outbound connectivity
     import requests
@@ -60,15 +111,111 @@ def debug_status():
         status["NETWORK_CHECK"]["BOT_API_PROXY"] = bot_api_proxy_check.status_code
     except Exception as e:
         status["NETWORK_CHECK"]["BOT_API_PROXY_ERROR"] = str(e)
-    
+
+    return jsonify(status)
+
+@app.route('/metrics')
+def prometheus_metrics():
     try:
-        if os.path.exists("telegram_service.log"):
-            with open("telegram_service.log", "r") as f:
-                status["LOG_TAIL"] = f.readlines()[-20:]
+        families = telegram_service.get_metrics()
     except Exception as e:
-        status["LOG_ERROR"] = str(e)
-        
-    return jsonify(status)
+        log_debug(f"Telegram metrics unavailable: {e}")
+        families = []
+    cache = download_cache.stats()
+    # The counts are this worker's own, and each scrape may reach another
+    # worker: the pid label keeps their series apart, for sum() to add up
+    pid = os.getpid()
+    families += [
+        metrics.snapshot('download_cache_hits_total', "Downloads served from the disk cache",
+                         {pid: cache['hits']}, 'pid', kind='counter'),
+        metrics.snapshot('download_cache_misses_total', "Downloads that went to Telegram",
+                         {pid: cache['misses']}, 'pid', kind='counter'),
+        metrics.snapshot('download_cache_evictions_total', "Cache entries evicted to make room",
+                         {pid: cache['evictions']}, 'pid', kind='counter'),
+        metrics.snapshot('download_cache_bytes', "Bytes held in the disk cache", cache['bytes']),
+        metrics.snapshot('download_cache_entries', "Files held in the disk cache", cache['entries']),
+    ]
+    return Response(metrics.render(families), mimetype='text/plain; version=0.0.4')
+
+def orphaned_messages(doomed):
+    """(telegram_id, chat_id) rows for messages only the doomed files point at.
+
+    `doomed` maps File (or an alias of it) to the condition selecting the
+    rows about to be deleted. Deduplicated uploads share one message, so it
+    may only be deleted together with its last reference. One query,
+    however many files are selected.
+    """
+    gone = aliased(File)
+    other = aliased(File)
+    still_used = db.select(other.id).where(
+        other.telegram_id == File.telegram_id,
+        other.chat_id == File.chat_id,
+        other.id.notin_(db.select(gone.id).where(doomed(gone)))
+    ).exists()
+    return db.session.query(File.telegram_id, File.chat_id).filter(
+        doomed(File),
+        File.telegram_id != 0,
+        ~still_used
+    ).distinct().all()
+
+def orphaned_chunks(doomed):
+    """Like orphaned_messages, for the chunk messages of chunked files."""
+    gone = aliased(File)
+    other = aliased(FileChunk)
+    still_used = db.select(other.id).where(
+        other.telegram_id == FileChunk.telegram_id,
+        other.chat_id == FileChunk.chat_id,
+        other.file_id.notin_(db.select(gone.id).where(doomed(gone)))
+    ).exists()
+    return db.session.query(FileChunk.telegram_id, FileChunk.chat_id).filter(
+        FileChunk.file_id.in_(db.select(File.id).where(doomed(File))),
+        ~still_used
+    ).distinct().all()
+
+def delete_files(doomed):
+    """Deletes the rows of the files `doomed` selects.
+
+    Returns (count, cleanup). Once the caller has committed, cleanup()
+    deletes the Telegram messages only these files used, and the staged
+    copies of uploads still queued for them. Rows go first, so
+    a failure in between leaves messages nothing points at (logged) rather
+    than rows pointing at deleted messages. The rows go in a single DELETE
+    and the messages in DELETE_BATCH_SIZE batches, so the number of round
+    trips stays bounded.
+    """
+    messages = orphaned_messages(doomed)
+    chunks = orphaned_chunks(doomed)
+    FolderStats.adjust(FolderStats.file_changes(doomed(File), sign=-1))
+    file_ids = db.select(File.id).where(doomed(File))
+    FileChunk.query.filter(FileChunk.file_id.in_(file_ids)).delete(synchronize_session=False)
+    Thumbnail.query.filter(Thumbnail.file_id.in_(file_ids)).delete(synchronize_session=False)
+    # Uploads still queued for these files are moot now, and so are their staged copies
+    jobs = UploadJob.query.filter(UploadJob.file_id.in_(file_ids))
+    staged = [path for (path,) in jobs.with_entities(UploadJob.path)]
+    jobs.delete(synchronize_session=False)
+    count = File.query.filter(doomed(File)).delete(synchronize_session=False)
+
+    def cleanup():
+        for m in messages:
+            download_cache.invalidate(cache_key(m))
+        for path in staged:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # already uploaded, or never written
+        delete_messages(set(messages) | set(chunks))
+    return count, cleanup
+
+def delete_messages(messages):
+    """Deletes (telegram_id, chat_id) messages whose rows are gone, logging any left behind."""
+    by_chat = {}
+    for telegram_id, chat_id in messages:
+        by_chat.setdefault(chat_id, []).append(telegram_id)
+    for chat_id, msg_ids in by_chat.items():
+        try:
+            telegram_service.delete_messages(msg_ids, chat_id=chat_id)
+        except Exception as e:
+            log_debug(f"Orphaned {len(msg_ids)} messages in chat {chat_id}, delete failed ({e}): {sorted(msg_ids)}")
 
 @app.route('/')
 def index():
@@ -76,14 +223,14 @@ def index():
 
 @app.route('/delete_file/<int:file_id>', methods=['POST'])
 def do_delete_file(file_id):
-    file_record = File.query.get_or_404(file_id)
+    name = File.query.get_or_404(file_id).name
     try:
-        if file_record.telegram_id != 0:
-            telegram_service.delete_messages([file_record.telegram_id])
-        db.session.delete(file_record)
+        _, cleanup = delete_files(lambda f: f.id == file_id)
         db.session.commit()
-        flash(f'File "{file_record.name}" deleted.')
+        cleanup()
+        flash(f'File "{name}" deleted.')
     except Exception as e:
+        db.session.rollback()
         flash(f'Delete failed: {str(e)}')
     return redirect(request.referrer)
 
@@ -95,50 +242,275 @@ def do_bulk_delete():
         return redirect(request.referrer)
     
     try:
-        files = File.query.filter(File.id.in_(file_ids)).all()
-        tg_ids = [f.telegram_id for f in files if f.telegram_id != 0]
-        
-        if tg_ids:
-            telegram_service.delete_messages(tg_ids)
-            
-        for f in files:
-            db.session.delete(f)
+        file_ids = [int(file_id) for file_id in file_ids]
+        count, cleanup = delete_files(lambda f: f.id.in_(file_ids))
         db.session.commit()
-        flash(f'Deleted {len(files)} items.')
+        cleanup()
+        flash(f'Deleted {count} items.')
     except Exception as e:
+        db.session.rollback()
         flash(f'Bulk delete failed: {str(e)}')
         
     return redirect(request.referrer)
 
+@app.route('/delete_folder/<int:folder_id>', methods=['POST'])
+def do_delete_folder(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    name, parent_id = folder.name, folder.parent_id
+    try:
+        tree = Folder.subtree_ids(folder_id)
+        count, cleanup = delete_files(lambda f: f.folder_id.in_(tree))
+        FolderStats.query.filter(FolderStats.folder_id.in_(tree)).delete(synchronize_session=False)
+        Folder.query.filter(Folder.id.in_(tree)).delete(synchronize_session=False)
+        db.session.commit()
+        cleanup()
+        flash(f'Folder "{name}" and {count} files deleted.')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Folder delete failed: {str(e)}')
+        return redirect(request.referrer or url_for('dashboard'))
+    return redirect(url_for('dashboard', folder_id=parent_id))
+
+@app.route('/rename_file/<int:file_id>', methods=['POST'])
+def do_rename_file(file_id):
+    file_record = File.query.get_or_404(file_id)
+    old_name = file_record.name
+    name = secure_filename(request.form.get('name', ''))
+    if not name:
+        flash('Invalid file name.')
+        return redirect(request.referrer or url_for('dashboard'))
+    try:
+        # The search index follows through its triggers / expression index
+        file_record.name = name
+        db.session.commit()
+        flash(f'File "{old_name}" renamed to "{name}".')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Rename failed: {str(e)}')
+    return redirect(request.referrer or url_for('dashboard', folder_id=file_record.folder_id))
+
+PAGE_SORTS = ('name', 'created_at')
+SEARCH_SORTS = PAGE_SORTS + ('size',)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(kind, item, sort):
+    value = getattr(item, sort)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([kind, value, item.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor, sort):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    kind, value, item_id = json.loads(raw)
+    if kind not in ('folder', 'file'):
+        raise ValueError(kind)
+    if sort == 'created_at':
+        value = datetime.fromisoformat(value)
+    return kind, value, int(item_id)
+
+def keyset_page(query, model, sort, descending, after, limit):
+    sort_column = getattr(model, sort)
+    if after is not None:
+        key, value = tuple_(sort_column, model.id), tuple_(literal(after[0], sort_column.type), literal(after[1]))
+        query = query.filter(key < value if descending else key > value)
+    if descending:
+        query = query.order_by(sort_column.desc(), model.id.desc())
+    else:
+        query = query.order_by(sort_column, model.id)
+    return query.limit(limit).all()
+
+def folder_page(folder_id, sort='name', descending=False, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """One page of a folder's children: subfolders first, then files.
+
+    Keyset pagination on (sort, id), so every page costs the same no
+    matter how deep into a large folder it is. Returns (folders, files,
+    next_cursor); next_cursor is None on the last page.
+    """
+    kind, after = 'folder', None
+    if cursor:
+        kind, value, item_id = decode_cursor(cursor, sort)
+        after = (value, item_id)
+
+    items = []
+    if kind == 'folder':
+        folders = keyset_page(Folder.query.filter(Folder.parent_id == folder_id), Folder, sort, descending, after, limit + 1)
+        items += [('folder', f) for f in folders]
+        after = None
+    if len(items) <= limit:
+        files = keyset_page(File.query.filter(File.folder_id == folder_id), File, sort, descending, after, limit + 1 - len(items))
+        items += [('file', f) for f in files]
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(*items[-1], sort)
+    return (
+        [item for kind, item in items if kind == 'folder'],
+        [item for kind, item in items if kind == 'file'],
+        next_cursor
+    )
+
+def page_args(sorts=PAGE_SORTS):
+    sort = request.args.get('sort', 'name')
+    if sort not in sorts:
+        sort = 'name'
+    descending = request.args.get('order', 'desc' if sort == 'created_at' else 'asc') == 'desc'
+    return sort, descending
+
+@app.route('/api/folders/root/items')
+@app.route('/api/folders/<int:folder_id>/items')
+def folder_items(folder_id=None):
+    if folder_id is not None:
+        Folder.query.get_or_404(folder_id)
+    sort, descending = page_args()
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        folders, files, next_cursor = folder_page(folder_id, sort, descending, request.args.get('cursor'), limit)
+    except (ValueError, TypeError, binascii.Error):
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    items = [dict(f.to_dict(), type='folder') for f in folders]
+    items += [dict(f.to_dict(), type='file') for f in files]
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+SEARCH_FILTERS = ('q', 'folder_id', 'type', 'min_size', 'max_size', 'after', 'before')
+
+def search_page(cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """One page of files matching the request's search filters: (files, next_cursor).
+
+    Raises ValueError on malformed filters or cursor.
+    """
+    sort, descending = page_args(SEARCH_SORTS)
+    query = search.search_files(
+        request.args.get('q'),
+        folder_id=request.args.get('folder_id', type=int),
+        mime_type=request.args.get('type'),
+        min_size=request.args.get('min_size', type=int),
+        max_size=request.args.get('max_size', type=int),
+        created_after=request.args.get('after') or None,
+        created_before=request.args.get('before') or None
+    )
+    after = None
+    if cursor:
+        _, value, item_id = decode_cursor(cursor, sort)
+        after = (value, item_id)
+    files = keyset_page(query, File, sort, descending, after, limit + 1)
+    next_cursor = encode_cursor('file', files[limit - 1], sort) if len(files) > limit else None
+    return files[:limit], next_cursor
+
+@app.route('/api/search')
+def search_items():
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        files, next_cursor = search_page(request.args.get('cursor'), limit)
+    except (ValueError, TypeError, binascii.Error):
+        return jsonify({"error": "Invalid search filter or cursor"}), 400
+    items = [dict(f.to_dict(), type='file') for f in files]
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/search')
+def search_view():
+    try:
+        files, next_cursor = search_page()
+    except (ValueError, TypeError, binascii.Error):
+        flash('Invalid search filter.')
+        return redirect(url_for('dashboard'))
+    sort, descending = page_args(SEARCH_SORTS)
+    return render_template('dashboard.html',
+                           folders=[],
+                           files=files,
+                           current_folder=None,
+                           breadcrumbs=[],
+                           next_cursor=next_cursor,
+                           sort=sort,
+                           order='desc' if descending else 'asc',
+                           search={key: request.args[key] for key in SEARCH_FILTERS if request.args.get(key)},
+                           stream_uploads=Config.STREAM_UPLOADS,
+                           upload_compression=upload_compression())
+
+@app.route('/api/folders/root/stats')
+@app.route('/api/folders/<int:folder_id>/stats')
+def folder_stats(folder_id=None):
+    if folder_id is not None:
+        Folder.query.get_or_404(folder_id)
+    return jsonify(FolderStats.get(folder_id).to_dict())
+
+@app.route('/api/quota')
+def quota():
+    usage = FolderStats.get()
+    used = usage.total_bytes
+    limit = Config.STORAGE_QUOTA or None
+    return jsonify({
+        "used_bytes": used,
+        "file_count": usage.file_count,
+        "quota_bytes": limit,
+        "remaining_bytes": max(limit - used, 0) if limit else None,
+        "used_fraction": round(used / limit, 4) if limit else None
+    })
+
 @app.route('/dashboard')
 @app.route('/dashboard/<int:folder_id>')
 def dashboard(folder_id=None):
     current_folder = None
-    if folder_id:
-        current_folder = Folder.query.get_or_404(folder_id)
-        folders = Folder.query.filter_by(parent_id=folder_id).all()
-        files = File.query.filter_by(folder_id=folder_id).all()
-    else:
-        folders = Folder.query.filter_by(parent_id=None).all()
-        files = File.query.filter_by(folder_id=None).all()
-    
     breadcrumbs = []
-    temp = current_folder
-    while temp:
-        breadcrumbs.insert(0, temp)
-        temp = temp.parent if temp.parent_id else None
+    if folder_id:
+        breadcrumbs = Folder.with_ancestors(folder_id)
+        if not breadcrumbs:
+            abort(404)
+        current_folder = breadcrumbs[-1]
+
+    # Only the first page is rendered; the rest is fetched from
+    # /api/folders/<id>/items as the user scrolls.
+    sort, descending = page_args()
+    folders, files, next_cursor = folder_page(folder_id, sort, descending)
 
     return render_template('dashboard.html', 
                            folders=folders, 
                            files=files, 
                            current_folder=current_folder, 
-                           breadcrumbs=breadcrumbs)
+                           breadcrumbs=breadcrumbs,
+                           next_cursor=next_cursor,
+                           sort=sort,
+                           order='desc' if descending else 'asc',
+                           stats=FolderStats.get(folder_id),
+                           stream_uploads=Config.STREAM_UPLOADS,
+                           upload_compression=upload_compression())
 
 @app.route('/upload_progress/<task_id>')
 def upload_progress(task_id):
     percent = telegram_service.get_progress(task_id)
     return jsonify({"progress": percent})
 
+@app.route('/upload_progress/stream')
+def upload_progress_stream():
+    """Server-Sent Events with progress for all of this browser's uploads.
+
+    Ends when none are left in flight; EventSource reconnects on its own
+    and gets the current state first.
+    """
+    owner = browser_id()
+
+    def events():
+        yield "retry: 2000\n\n"
+        for batch in telegram_service.stream_progress(owner, timeout=Config.PROGRESS_STREAM_SECONDS):
+            if batch is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"data: {json.dumps(batch)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no', # don't let a proxy hold events back
+    })
+
+def upload_compression():
+    """The types the dashboard may stream, as compression never applies to them; None if it is off."""
+    if Config.UPLOAD_COMPRESSION == 'off':
+        return None
+    return {'types': compression.INCOMPRESSIBLE_TYPES, 'subtypes': compression.INCOMPRESSIBLE_SUBTYPES}
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -151,24 +523,51 @@ def upload_file():
     folder_id = request.form.get('folder_id')
     folder_id = int(folder_id) if folder_id and folder_id != 'None' else None
     task_id = request.form.get('task_id')
+    telegram_service.register_task(task_id, browser_id())
 
     filename = secure_filename(file.filename)
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
-    
-    file.save(upload_path)
+    upload_path = staged_path(filename)
     
+    # Compressible content is compressed on its way to disk, judged by the first MB
+    first = file.stream.read(1024 * 1024)
+    codec = None
+    if Config.UPLOAD_COMPRESSION != 'off' and \
+            compression.worth_compressing(first, file.content_type, Config.COMPRESSION_MIN_RATIO):
+        codec = compression.default_codec() if Config.UPLOAD_COMPRESSION == 'auto' else Config.UPLOAD_COMPRESSION
+        upload_path += compression.EXTENSIONS[codec]
+
+    # Hash while saving so duplicates can be caught before any transfer
+    digest = hashlib.sha256()
+    size = 0
+    packer = compression.compressor(codec, Config.COMPRESSION_LEVEL) if codec else None
+    with open(upload_path, 'wb') as out:
+        chunk = first
+        while chunk:
+            digest.update(chunk)
+            size += len(chunk)
+            out.write(packer.compress(chunk) if packer else chunk)
+            chunk = file.stream.read(1024 * 1024)
+        if packer:
+            out.write(packer.flush())
+    sha256 = digest.hexdigest()
+
     # Create DB entry (placeholder)
     new_file = File(
         name=filename,
-        size=os.path.getsize(upload_path),
+        size=size,
         mime_type=file.content_type,
         telegram_id=0,
         chat_id=0,
-        folder_id=folder_id
+        folder_id=folder_id,
+        sha256=sha256,
+        codec=codec
     )
+
+    # Same bytes already on Telegram: point at that message instead
+    original = File.find_uploaded(sha256)
+    if original:
+        return share_upload(new_file, original, upload_path, task_id)
+
     db.session.add(new_file)
     db.session.commit()
     
@@ -177,6 +576,113 @@ def upload_file():
     
     return jsonify({"status": "uploading", "task_id": task_id}), 202
 
+def staged_path(filename):
+    """Where an upload waits for Telegram; unique, as equal names can be uploaded at once."""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{filename}")
+
+def share_upload(new_file, original, upload_path, task_id):
+    """Adds `new_file` pointing at the message(s) `original` is stored in, dropping the staged copy."""
+    new_file.share_storage(original)
+    db.session.add(new_file)
+    FolderStats.adjust({new_file.folder_id: (1, new_file.size)})
+    db.session.commit()
+    os.remove(upload_path)
+    telegram_service.finish_task(task_id)
+    return jsonify({"status": "deduplicated", "task_id": task_id}), 202
+
+def receive_claimed_duplicate(filename, size, folder_id, task_id, claimed):
+    """Takes an /upload_stream body whose hash the browser says is already stored.
+
+    Nothing goes to Telegram while it arrives: the body is hashed on its
+    way to the staging folder, and the new row shares the stored message
+    if the hash holds. Otherwise the staged copy is uploaded like /upload's.
+    """
+    upload_path = staged_path(filename)
+    digest = hashlib.sha256()
+    received = 0
+    with open(upload_path, 'wb') as out:
+        for chunk in iter(lambda: request.stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+            received += len(chunk)
+            out.write(chunk)
+    if received != size:
+        os.remove(upload_path)
+        return jsonify({"error": f"Upload body ended {size - received} bytes early"}), 400
+
+    new_file = File(
+        name=filename,
+        size=size,
+        mime_type=request.mimetype or None,
+        telegram_id=0,
+        chat_id=0,
+        folder_id=folder_id,
+        sha256=digest.hexdigest()
+    )
+    # Looked up again: the original may have been deleted while the body arrived
+    original = File.find_uploaded(claimed) if new_file.sha256 == claimed else None
+    if original:
+        return share_upload(new_file, original, upload_path, task_id)
+
+    log_debug(f"Upload of {filename} did not match its X-Content-SHA256; uploading it staged")
+    db.session.add(new_file)
+    db.session.commit()
+    telegram_service.submit_upload(upload_path, db_file_id=new_file.id, task_id=task_id)
+    return jsonify({"status": "uploading", "task_id": task_id}), 202
+
+# X-Content-SHA256, as the dashboard sends it
+SHA256_HEX = re.compile('[0-9a-f]{64}')
+
+@app.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    # Raw request body (not multipart) so it can be forwarded as it arrives
+    size = request.content_length
+    if not size:
+        return jsonify({"error": "Content-Length required"}), 411
+
+    filename = secure_filename(request.args.get('name', ''))
+    if not filename:
+        return jsonify({"error": "Empty filename"}), 400
+
+    folder_id = request.args.get('folder_id')
+    folder_id = int(folder_id) if folder_id and folder_id != 'None' else None
+    task_id = request.args.get('task_id')
+    telegram_service.register_task(task_id, browser_id())
+
+    # The browser sends the content's hash when it could compute it
+    claimed = request.headers.get('X-Content-SHA256', '').lower()
+    if SHA256_HEX.fullmatch(claimed) and File.find_uploaded(claimed):
+        return receive_claimed_duplicate(filename, size, folder_id, task_id, claimed)
+
+    # Create DB entry (placeholder)
+    new_file = File(
+        name=filename,
+        size=size,
+        mime_type=request.mimetype or None,
+        telegram_id=0,
+        chat_id=0,
+        folder_id=folder_id
+    )
+    db.session.add(new_file)
+    db.session.commit()
+
+    try:
+        telegram_service.upload_stream(request.stream, size, filename, db_file_id=new_file.id, task_id=task_id)
+    except Exception as e:
+        log_debug(f"Streaming upload failed: {str(e)}")
+        try:
+            # Also drops any chunks of a large file that were already sent
+            file_id = new_file.id
+            _, cleanup = delete_files(lambda f: f.id == file_id)
+            db.session.commit()
+            cleanup()
+        except Exception as cleanup_error:
+            db.session.rollback()
+            log_debug(f"Cleanup after failed streaming upload failed: {str(cleanup_error)}")
+        return jsonify({"error": str(e)}), 502
+
+    return jsonify({"status": "uploading", "task_id": task_id}), 202
+
 @app.route('/create_folder', methods=['POST'])
 def create_folder():
     name = request.form.get('name')
@@ -186,6 +692,8 @@ def create_folder():
     if name:
         new_folder = Folder(name=name, parent_id=parent_id)
         db.session.add(new_folder)
+        db.session.flush()
+        db.session.add(FolderStats(folder_id=new_folder.id, file_count=0, total_bytes=0))
         db.session.commit()
         flash(f'Folder "{name}" created!')
         
@@ -198,20 +706,171 @@ def download_file(file_id):
         flash('File is still uploading to Telegram. Please wait.')
         return redirect(request.referrer)
 
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"dl_{file_record.name}")
-    try:
-        if not os.path.exists(app.config['UPLOAD_FOLDER']):
-            os.makedirs(app.config['UPLOAD_FOLDER'])
+    # A message never gets new content, so chat + message id + size is a
+    # strong validator. Message ids are only unique within their chat.
+    etag = f"{file_record.chat_id or 0}-{file_record.telegram_id}-{file_record.size}"
 
-        with open(temp_path, 'wb') as f:
-            telegram_service.download_file_to_stream(file_record.telegram_id, f)
-            
-        return send_file(temp_path, as_attachment=True, download_name=file_record.name)
+    cached_path = download_cache.get(cache_key(file_record))
+    if cached_path:
+        # send_file handles Range/If-Range itself for local files
+        return send_file(
+            cached_path,
+            mimetype=file_record.mime_type or 'application/octet-stream',
+            as_attachment=True,
+            download_name=file_record.name,
+            etag=etag,
+            last_modified=file_record.created_at,
+            conditional=True
+        )
+
+    byte_range = None
+    if request.range and file_record.size:
+        if_range = request.if_range
+        if if_range.etag:
+            honour_range = if_range.etag == etag
+        elif if_range.date:
+            honour_range = file_record.created_at is not None and \
+                if_range.date.replace(tzinfo=None) == file_record.created_at.replace(microsecond=0)
+        else:
+            honour_range = True
+        if honour_range:
+            byte_range = request.range.range_for_length(file_record.size)
+            if byte_range is None and len(request.range.ranges) == 1:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f"bytes */{file_record.size}"
+                return response
+
+    try:
+        location = {'chat_id': file_record.chat_id, 'chunk_map': file_record.chunk_map()}
+        if file_record.codec:
+            # Stored compressed: ranges are cut from the decompressed stream
+            _, stored = telegram_service.open_download(file_record.telegram_id, **location)
+            size = file_record.size
+            start, stop = byte_range or (0, size)
+            chunks = compression.decompress_stream(stored, file_record.codec, start, stop - start)
+        elif byte_range:
+            start, stop = byte_range
+            size, chunks = telegram_service.open_download(file_record.telegram_id, offset=start, length=stop - start, **location)
+            if size != file_record.size:
+                # Stored media differs from what we recorded (e.g. a compressed
+                # photo); offsets are meaningless, so send it whole.
+                chunks.close()
+                byte_range = None
+                size, chunks = telegram_service.open_download(file_record.telegram_id, **location)
+        else:
+            size, chunks = telegram_service.open_download(file_record.telegram_id, **location)
     except Exception as e:
         log_debug(f"Download failed: {str(e)}")
         flash(f'Download failed: {str(e)}')
         return redirect(request.referrer)
 
+    # Bytes go straight from Telegram to the client; full downloads are
+    # also written to the cache as they pass, and kept only if complete.
+    if not byte_range and download_cache.can_store(size):
+        chunks = download_cache.writer(cache_key(file_record), size).tee(chunks)
+    response = Response(
+        chunks,
+        mimetype=file_record.mime_type or 'application/octet-stream',
+        direct_passthrough=True
+    )
+    if byte_range:
+        start, stop = byte_range
+        response.status_code = 206
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        response.content_length = size
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = file_record.created_at
+    response.headers['Content-Disposition'] = attachment_header(file_record.name)
+    return response
+
+@app.route('/thumbnail/<int:file_id>')
+def file_thumbnail(file_id):
+    thumbnail = db.session.get(Thumbnail, file_id)
+    if thumbnail is None:
+        abort(404)
+    response = Response(thumbnail.data, mimetype='image/jpeg')
+    # Tiles link here with ?v=<telegram_id>, so a file id reused after a
+    # delete gets a new URL and the cached image can be kept for good
+    response.headers['Cache-Control'] = f'public, max-age={Config.THUMBNAIL_MAX_AGE}, immutable'
+    response.set_etag(hashlib.md5(thumbnail.data).hexdigest())
+    return response.make_conditional(request)
+
+def open_content(file_record):
+    """Starts reading a stored file's whole content; returns an iterator of its bytes.
+
+    Only queues the download: waiting for it is left to the first read.
+    """
+    cached_path = download_cache.get(cache_key(file_record))
+    if cached_path:
+        return zipstream.read_file(cached_path)
+    chunk_map = db.session.get(File, file_record.id).chunk_map() if file_record.chunk_count else None
+    _, chunks = telegram_service.open_download(file_record.telegram_id, chat_id=file_record.chat_id,
+                                               chunk_map=chunk_map, wait=False)
+    return compression.decompress_stream(chunks, file_record.codec) if file_record.codec else chunks
+
+def folder_entries(folder):
+    """ZipEntry objects for a folder's subtree: its folders, then its stored files."""
+    tree = Folder.subtree_ids(folder.id)
+    folders = {f.id: f for f in Folder.query.filter(Folder.id.in_(tree))}
+
+    paths = {}
+    def path_of(folder_id):
+        if folder_id not in paths:
+            f = folders[folder_id]
+            name = f.name.replace('/', '_').strip('.') or f'folder-{f.id}'
+            paths[folder_id] = name if f.id == folder.id else f"{path_of(f.parent_id)}/{name}"
+        return paths[folder_id]
+
+    entries = [zipstream.ZipEntry(path_of(folder_id), modified=folders[folder_id].created_at)
+               for folder_id in sorted(folders, key=path_of)]
+    # Plain rows rather than File objects keep big folders light; uploads still running are left out
+    files = db.session.query(
+        File.id, File.name, File.size, File.created_at, File.folder_id,
+        File.telegram_id, File.chat_id, File.codec, File.chunk_count
+    ).filter(File.folder_id.in_(tree), File.telegram_id != 0).order_by(File.folder_id, File.name, File.id)
+    taken = set()
+    for f in files:
+        name = f"{path_of(f.folder_id)}/{f.name}"
+        stem, dot, ext = f.name.rpartition('.')
+        copy = 1
+        while name in taken:
+            copy += 1
+            name = f"{path_of(f.folder_id)}/{stem} ({copy}).{ext}" if dot and stem else f"{path_of(f.folder_id)}/{f.name} ({copy})"
+        taken.add(name)
+        entries.append(zipstream.ZipEntry(name, f.size, f.created_at, open=lambda f=f: open_content(f)))
+    return entries
+
+@app.route('/download_folder/<int:folder_id>')
+def download_folder(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    # One archive never takes every download slot, leaving room for the file it is writing
+    prefetch = max(min(Config.FOLDER_ZIP_PREFETCH, Config.DOWNLOAD_CONCURRENCY - 1), 0)
+    archive = zipstream.stream_zip(folder_entries(folder), prefetch, log=log_debug)
+    response = Response(stream_with_context(archive), mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = attachment_header(f"{folder.name}.zip")
+    return response
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Adds columns and indexes missing from an existing database."""
+    upgrade_schema()
+    print(f"Database schema is up to date; search uses {search.install()}.")
+
+@app.cli.command('recompute-folder-stats')
+def recompute_folder_stats_command():
+    """Rebuilds the per-folder file counts and sizes from the files table."""
+    off = FolderStats.recompute()
+    print(f"Folder stats recomputed; {len(off)} rows were off.")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Refills the file search index from the files table."""
+    search.rebuild()
+    print("Search index rebuilt.")
+
 # Initialize Telegram Service
 telegram_service.start(app)
 
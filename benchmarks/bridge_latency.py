@@ -0,0 +1,84 @@
+"""Round-trip latency of a no-op command between a web thread and the loop.
+
+Compares the old bridge (loop polls a queue.Queue every 100 ms, caller blocks
+on a per-thread result queue) with the current run_coroutine_threadsafe path.
+
+    python -m benchmarks.bridge_latency [--requests 200]
+"""
+import argparse
+import asyncio
+import os
+import queue
+import statistics
+import threading
+import time
+
+os.environ.setdefault('API_ID', '')
+
+from benchmarks.fakes import FakeTelegramClient
+from telegram_service import TelegramService
+
+
+class LegacyBridge:
+    """The pre-futures request path, kept here only for comparison."""
+
+    def __init__(self, client):
+        self.client = client
+        self.request_queue = queue.Queue()
+        self.result_queues = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_until_complete, args=(self._worker(),), daemon=True).start()
+
+    async def _worker(self):
+        while True:
+            try:
+                thread_id, cmd, args = self.request_queue.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(0.1)
+                continue
+            await self.client.delete_messages('me', args['msg_ids'])
+            self.result_queues[thread_id].put(('ok', None))
+
+    def delete_messages(self, msg_ids):
+        thread_id = threading.get_ident()
+        res_q = queue.Queue()
+        self.result_queues[thread_id] = res_q
+        try:
+            self.request_queue.put((thread_id, 'delete', {'msg_ids': msg_ids}))
+            return res_q.get(timeout=300)
+        finally:
+            self.result_queues.pop(thread_id, None)
+
+
+def measure(call, n):
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        call([1])
+        samples.append((time.perf_counter() - t0) * 1000)
+        # Spread requests out so the legacy poller is idle when they arrive
+        time.sleep(0.003)
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 3),
+        'p99_ms': round(samples[int(len(samples) * 0.99) - 1], 3),
+        'mean_ms': round(statistics.mean(samples), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    legacy = LegacyBridge(FakeTelegramClient())
+    service = TelegramService()
+    service.start(client=FakeTelegramClient())
+    service.ready_event.wait(5)
+
+    for name, call in (('legacy_polling', legacy.delete_messages), ('futures', service.delete_messages)):
+        print(f"{name:16} {measure(call, args.requests)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Round trips and wall time for deleting a large folder tree.
+
+Seeds a throwaway SQLite database with a folder tree holding many files,
+runs the real service loop against FakeTelegramClient, and deletes the
+tree through /delete_folder. Both SQL statements and Telegram calls must
+stay bounded: one statement per step, one call per DELETE_BATCH_SIZE ids.
+
+    python -m benchmarks.bulk_delete [--files 10000] [--folders 50] [--latency 0.05]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+os.environ.setdefault('API_ID', '')
+_db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from sqlalchemy import event, insert
+
+from app import app, telegram_service
+from benchmarks.fakes import FakeTelegramClient
+from database import db, File, Folder
+
+
+def seed(folders, files):
+    root = Folder(name='root')
+    db.session.add(root)
+    db.session.flush()
+    folder_ids = [root.id]
+    for i in range(folders - 1):
+        # Each folder hangs off an earlier one, giving a mix of depth and breadth
+        folder = Folder(name=f'folder-{i}', parent_id=folder_ids[i // 2])
+        db.session.add(folder)
+        db.session.flush()
+        folder_ids.append(folder.id)
+    db.session.execute(insert(File), [
+        {
+            'name': f'file-{i:06}.bin',
+            'size': 1024,
+            'telegram_id': i + 1,
+            'chat_id': 777,
+            'folder_id': folder_ids[i % len(folder_ids)],
+        }
+        for i in range(files)
+    ])
+    db.session.commit()
+    return root.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--folders', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake Telegram call")
+    args = parser.parse_args()
+
+    client = FakeTelegramClient(latency=args.latency)
+    calls = []
+    delete_messages = client.delete_messages
+
+    async def counting_delete(entity, message_ids):
+        calls.append(len(message_ids))
+        await delete_messages(entity, message_ids)
+
+    client.delete_messages = counting_delete
+    telegram_service.start(app, client=client)
+    telegram_service.ready_event.wait(10)
+
+    with app.app_context():
+        root_id = seed(args.folders, args.files)
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+    t0 = time.perf_counter()
+    response = app.test_client().post(f'/delete_folder/{root_id}')
+    elapsed = time.perf_counter() - t0
+    assert response.status_code == 302
+
+    with app.app_context():
+        left = File.query.count() + Folder.query.count()
+    print(f"files={args.files} folders={args.folders} latency={args.latency * 1000:.0f}ms")
+    print(f"telegram calls={len(calls)} (largest {max(calls, default=0)} ids)  sql statements={len(statements)}")
+    print(f"elapsed={elapsed:.2f}s  rows left={left}")
+
+
+if __name__ == '__main__':
+    main()
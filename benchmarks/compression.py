@@ -0,0 +1,130 @@
+"""Compression ratio and upload time saved on a generated corpus.
+
+Each file is uploaded raw and compressed with every available codec over
+fake senders sharing one pipe of --bandwidth-mb MB/s. The compressed time
+includes compressing it, done while staging in the app; decompression is
+what a download adds. Files worth_compressing() turns down are uploaded
+raw, as the app would.
+
+    python -m benchmarks.compression [--size-mb 8] [--bandwidth-mb 4] [--workers 4]
+"""
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import random
+import time
+
+from benchmarks.fakes import FakeSender
+from compression import compressor, decompress_stream, worth_compressing, zstandard
+from transfer import ParallelUploader
+
+BLOCK = 1024 * 1024
+
+
+def make_corpus(size, seed):
+    rng = random.Random(seed)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+    paths = ['/api/files', '/download/%d', '/upload', '/folder/%d', '/upload_progress/stream']
+
+    def fill(make_line):
+        out = io.BytesIO()
+        while out.tell() < size:
+            out.write(make_line())
+        return out.getvalue()[:size]
+
+    log = fill(lambda: (
+        f"2026-10-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+        f"{rng.choice(levels)} GET {rng.choice(paths).replace('%d', str(rng.randint(1, 99999)))} "
+        f"{rng.choice([200, 200, 200, 206, 302, 404])} {rng.randint(1, 900)}ms\n"
+    ).encode())
+    csv = fill(lambda: (
+        f"{rng.randint(1, 10 ** 6)},{rng.choice(['alice', 'bob', 'carol', 'dave'])},"
+        f"{rng.uniform(0, 1000):.2f},{rng.choice(['paid', 'pending', 'refunded'])},2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}\n"
+    ).encode())
+    backup = fill(lambda: (json.dumps({
+        'id': rng.randint(1, 10 ** 6),
+        'name': f"file-{rng.randint(1, 10 ** 5)}.bin",
+        'size': rng.randint(1, 10 ** 9),
+        'mime_type': rng.choice(['text/plain', 'image/png', 'application/pdf']),
+        'folder_id': rng.randint(1, 500),
+    }) + '\n').encode())
+    return [
+        ('server.log', 'text/plain', log),
+        ('orders.csv', 'text/csv', csv),
+        ('backup.json', 'application/json', backup),
+        ('logs.gz', 'application/gzip', gzip.compress(log, 6)),
+        ('random.bin', 'application/octet-stream', rng.randbytes(size)),
+    ]
+
+
+async def _parts(data, part_size):
+    for i in range(0, len(data), part_size):
+        yield data[i:i + part_size]
+
+
+async def upload(data, args):
+    senders = [FakeSender(args.latency, args.bandwidth_mb * 1024 * 1024, seed=i) for i in range(args.workers)]
+    for sender in senders[1:]:
+        sender._pipe = senders[0]._pipe # one account's bandwidth
+    uploader = ParallelUploader(senders)
+    t0 = time.perf_counter()
+    await uploader.upload(_parts(data, uploader.part_size), len(data), 'bench.bin')
+    return time.perf_counter() - t0
+
+
+def compress(data, codec, level):
+    packer = compressor(codec, level)
+    t0 = time.perf_counter()
+    out = bytearray()
+    for i in range(0, len(data), BLOCK):
+        out += packer.compress(data[i:i + BLOCK])
+    out += packer.flush()
+    return bytes(out), time.perf_counter() - t0
+
+
+def decompress(packed, codec):
+    t0 = time.perf_counter()
+    blocks = (packed[i:i + BLOCK] for i in range(0, len(packed), BLOCK))
+    size = sum(len(data) for data in decompress_stream(blocks, codec))
+    return size, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=8, help="per corpus file")
+    parser.add_argument('--bandwidth-mb', type=float, default=4, help="upload bandwidth, MB/s")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--level', type=int, default=0, help="0 for each codec's default")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    codecs = ['zlib'] + (['zstd'] if zstandard else [])
+    corpus = make_corpus(int(args.size_mb * 1024 * 1024), args.seed)
+    totals = {codec: [0.0, 0.0] for codec in codecs}
+    print(f"{'file':12} {'codec':5} {'ratio':>6} {'compress':>10} {'decompress':>11} {'raw':>7} {'compressed':>11} {'saved':>6}")
+    for name, mime_type, data in corpus:
+        raw_time = asyncio.run(upload(data, args))
+        worth = worth_compressing(data[:BLOCK], mime_type)
+        for codec in codecs:
+            packed, compress_time = compress(data, codec, args.level)
+            size, decompress_time = decompress(packed, codec)
+            assert size == len(data), "decompressed size does not match"
+            if worth:
+                total_time = compress_time + asyncio.run(upload(packed, args))
+            else:
+                total_time = raw_time # stays raw; the trial costs next to nothing
+            totals[codec][0] += raw_time
+            totals[codec][1] += total_time
+            mb = len(data) / 1024 / 1024
+            print(f"{name:12} {codec:5} {len(packed) / len(data):6.3f} {mb / compress_time:6.0f}MB/s {mb / decompress_time:7.0f}MB/s "
+                  f"{raw_time:6.2f}s {total_time:10.2f}s {1 - total_time / raw_time:6.0%}"
+                  + ('' if worth else '  (not compressed)'))
+    for codec, (raw_time, total_time) in totals.items():
+        print(f"total {codec:5} raw {raw_time:.2f}s, with compression {total_time:.2f}s, saved {1 - total_time / raw_time:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Query count and latency of dashboard() for deep, crowded folder trees.
+
+Seeds a throwaway SQLite database with a chain of nested folders and many
+files in the deepest one, then renders the dashboard at several depths.
+The number of SQL statements per page must not grow with the depth.
+
+    python -m benchmarks.dashboard_queries [--depth 200] [--files 20000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+os.environ.setdefault('API_ID', '')
+_db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from sqlalchemy import event, insert
+
+from app import app
+from database import db, File, Folder
+
+
+def seed(depth, files):
+    folder_ids = []
+    parent_id = None
+    for level in range(depth):
+        folder = Folder(name=f'level-{level}', parent_id=parent_id)
+        db.session.add(folder)
+        db.session.flush()
+        folder_ids.append(folder.id)
+        parent_id = folder.id
+    db.session.execute(insert(File), [
+        {
+            'name': f'file-{i:06}.bin',
+            'size': 1024 * (i % 4096 + 1),
+            'mime_type': 'application/octet-stream',
+            'telegram_id': i + 1,
+            'chat_id': 1,
+            'folder_id': folder_ids[-1],
+        }
+        for i in range(files)
+    ])
+    db.session.commit()
+    return folder_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=200)
+    parser.add_argument('--files', type=int, default=20000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        folder_ids = seed(args.depth, args.files)
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+    client = app.test_client()
+    checkpoints = sorted({1, 10, args.depth // 2, args.depth - 1} - {0})
+    for level in checkpoints:
+        folder_id = folder_ids[level - 1]
+        statements.clear()
+        t0 = time.perf_counter()
+        response = client.get(f'/dashboard/{folder_id}')
+        elapsed = (time.perf_counter() - t0) * 1000
+        assert response.status_code == 200
+        print(f"depth={level:<5} queries={len(statements):<3} {elapsed:9.1f} ms")
+
+    statements.clear()
+    t0 = time.perf_counter()
+    client.get(f'/dashboard/{folder_ids[-1]}')
+    elapsed = (time.perf_counter() - t0) * 1000
+    print(f"depth={args.depth:<5} queries={len(statements):<3} {elapsed:9.1f} ms  ({args.files} files)")
+
+
+if __name__ == '__main__':
+    main()
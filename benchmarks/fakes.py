@@ -0,0 +1,208 @@
+"""In-process stand-ins for Telethon objects used by the benchmarks.
+
+Nothing here touches the network, so benchmark numbers measure our own
+plumbing rather than Telegram. Messages carry real Telethon media types so
+code that inspects them (e.g. transfer.media_location) works unchanged.
+"""
+import asyncio
+import itertools
+import random
+from datetime import datetime
+
+from telethon import errors, functions, types
+
+FAKE_DC_ID = 2
+
+
+class FakeSession:
+    dc_id = FAKE_DC_ID
+
+    def save(self):
+        return ''
+
+
+class FakeFile:
+    def __init__(self, size):
+        self.size = size
+
+
+class FakeMessage:
+    def __init__(self, id, chat_id, data=b''):
+        self.id = id
+        self.chat_id = chat_id
+        self.data = data
+        self.media = types.MessageMediaDocument(document=types.Document(
+            id=id,
+            access_hash=0,
+            file_reference=b'',
+            date=datetime.utcnow(),
+            mime_type='application/octet-stream',
+            size=len(data),
+            dc_id=FAKE_DC_ID,
+            attributes=[]
+        ))
+        self.file = FakeFile(len(data))
+
+
+def flood_wait(rng, rate, seconds, request=None):
+    """Raises a FloodWaitError for a `rate` share of calls."""
+    if rate and rng.random() < rate:
+        raise errors.FloodWaitError(request=request, capture=seconds)
+
+
+class FakeTelegramClient:
+    """Minimal async client with a configurable per-call latency (seconds).
+
+    `bandwidth` (bytes/s) paces media going through send_file and
+    iter_download. `flood_rate` makes that share of send_file and
+    delete_messages calls raise FloodWaitError(`flood_seconds`).
+    """
+
+    def __init__(self, latency=0.0, chat_id=777, bandwidth=None, flood_rate=0.0, flood_seconds=1, seed=None):
+        self.latency = latency
+        self.chat_id = chat_id
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self._random = random.Random(seed)
+        self._pipe = asyncio.Lock()
+        self.session = FakeSession()
+        self.messages = {}
+        self._ids = itertools.count(1)
+        # Parts saved through FakeSender connections, by (file_id, index)
+        self.parts = {}
+        # Stored media bytes by document id, readable through FakeSender
+        self.documents = {}
+
+    async def _rpc(self, size=0):
+        if size and self.bandwidth:
+            async with self._pipe:
+                await asyncio.sleep(size / self.bandwidth)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def store(self, data):
+        """Puts `data` in a new message right away, as if sent earlier."""
+        msg = FakeMessage(next(self._ids), self.chat_id, data)
+        self.messages[msg.id] = msg
+        self.documents[msg.id] = data
+        return msg
+
+    async def connect(self):
+        await self._rpc()
+
+    async def is_user_authorized(self):
+        return True
+
+    def is_connected(self):
+        return True
+
+    async def get_entity(self, entity):
+        # Every entity resolves to this account's own chat
+        return types.User(id=self.chat_id, is_self=True)
+
+    async def send_file(self, entity, file, progress_callback=None, **kwargs):
+        flood_wait(self._random, self.flood_rate, self.flood_seconds)
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                data = f.read()
+        elif hasattr(file, 'parts'):
+            # InputFile/InputFileBig from a parallel upload
+            data = b''.join(self.parts.pop((file.id, i)) for i in range(file.parts))
+        else:
+            data = bytes(file)
+        # Only a path still has its bytes to send; parts went up beforehand
+        await self._rpc(len(data) if isinstance(file, str) else 0)
+        if progress_callback:
+            progress_callback(len(data), len(data))
+        return self.store(data)
+
+    async def get_messages(self, entity, ids=None):
+        await self._rpc()
+        return self.messages.get(ids)
+
+    async def iter_download(self, media, offset=0, request_size=512 * 1024, **kwargs):
+        data = self.documents[media.document.id]
+        while offset < len(data):
+            chunk = data[offset:offset + request_size]
+            await self._rpc(len(chunk))
+            yield chunk
+            offset += request_size
+
+    async def download_media(self, message, file=None, **kwargs):
+        await self._rpc()
+        file.write(message.data)
+
+    async def delete_messages(self, entity, message_ids):
+        flood_wait(self._random, self.flood_rate, self.flood_seconds)
+        await self._rpc()
+        for mid in message_ids:
+            self.messages.pop(mid, None)
+            self.documents.pop(mid, None)
+
+
+class FakeSender:
+    """Stand-in for an MTProtoSender: one connection with its own bandwidth.
+
+    Payload bytes go through the connection one request at a time at
+    `bandwidth` bytes/s, while the round trip (`latency`) overlaps, which is
+    roughly how a single TCP connection behaves. `fail_rate` makes a share
+    of requests raise so retry paths get exercised, and `flood_rate` a share
+    with FloodWaitError(`flood_seconds`). Saved parts land in
+    `store`, keyed by (file_id, part index); GetFile reads from `documents`.
+    """
+
+    def __init__(self, latency=0.05, bandwidth=2 * 1024 * 1024, fail_rate=0.0,
+                 store=None, documents=None, seed=None, flood_rate=0.0, flood_seconds=1):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.store = {} if store is None else store
+        self.documents = {} if documents is None else documents
+        self.requests = 0
+        self._pipe = asyncio.Lock()
+        self._random = random.Random(seed)
+
+    async def send(self, request):
+        self.requests += 1
+        flood_wait(self._random, self.flood_rate, self.flood_seconds, request)
+        if isinstance(request, functions.upload.GetFileRequest):
+            data = self.documents[request.location.id]
+            payload = data[request.offset:request.offset + request.limit]
+        else:
+            payload = request.bytes
+        async with self._pipe:
+            await asyncio.sleep(len(payload) / self.bandwidth)
+        await asyncio.sleep(self.latency)
+        if self._random.random() < self.fail_rate:
+            raise ConnectionError("injected failure")
+
+        if isinstance(request, functions.upload.GetFileRequest):
+            return types.upload.File(type=types.storage.FileUnknown(), mtime=datetime.utcnow(), bytes=payload)
+        self.store[(request.file_id, request.file_part)] = payload
+        return True
+
+
+class FakeSenderPool:
+    """Drop-in for transfer.SenderPool handing out FakeSender connections.
+
+    With `shared_pipe` all senders share the client's pipe, so `bandwidth`
+    caps the whole account rather than each connection.
+    """
+
+    def __init__(self, client, size, shared_pipe=False, **sender_options):
+        self.senders = [
+            FakeSender(store=client.parts, documents=client.documents, seed=i, **sender_options)
+            for i in range(size)
+        ]
+        if shared_pipe:
+            for sender in self.senders:
+                sender._pipe = client._pipe
+
+    async def get(self):
+        return list(self.senders)
+
+    async def close(self):
+        pass
@@ -0,0 +1,127 @@
+"""Latency of /api/search over a large generated catalog.
+
+Seeds a throwaway SQLite database with --files rows of realistic names
+(the FTS5 index is filled by its triggers as they go in), then times a
+mix of queries through the app, and the same name matches as plain LIKE
+scans for comparison.
+
+    python -m benchmarks.search [--files 1000000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('API_ID', '')
+_db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from sqlalchemy import func, insert
+
+from app import app
+from database import db, File, Folder
+import search
+
+WORDS = ['report', 'invoice', 'photo', 'backup', 'scan', 'contract', 'notes', 'budget', 'draft', 'final',
+         'holiday', 'meeting', 'slides', 'export', 'receipt', 'thesis', 'dataset', 'screenshot', 'video', 'archive']
+TYPES = [('pdf', 'application/pdf'), ('jpg', 'image/jpeg'), ('png', 'image/png'), ('mp4', 'video/mp4'),
+         ('zip', 'application/zip'), ('txt', 'text/plain'), ('csv', 'text/csv'), ('xlsx', 'application/vnd.ms-excel')]
+
+QUERIES = [
+    ('substring', {'q': 'voic'}),
+    ('prefix', {'q': 'screensh'}),
+    ('two terms', {'q': 'budget 2024'}),
+    ('rare', {'q': 'thesis-final-2019'}),
+    ('short term', {'q': 'q3'}),
+    ('type + size', {'q': 'photo', 'type': 'image', 'min_size': 5 * 1024 * 1024}),
+    ('by date', {'q': 'receipt', 'sort': 'created_at', 'order': 'desc'}),
+    ('filters only', {'type': 'video/mp4', 'sort': 'size', 'order': 'desc'}),
+]
+
+
+def seed(count, seed):
+    rng = random.Random(seed)
+    folders = []
+    for i in range(200):
+        folder = Folder(name=f'folder-{i}', parent_id=rng.choice(folders) if folders and i % 4 else None)
+        db.session.add(folder)
+        db.session.flush()
+        folders.append(folder.id)
+    start = datetime(2018, 1, 1)
+    batch = []
+    for i in range(count):
+        ext, mime_type = rng.choice(TYPES)
+        words = '-'.join(rng.sample(WORDS, rng.randint(1, 3)))
+        tag = rng.choice(['', f'-{rng.randint(2015, 2026)}', f'-q{rng.randint(1, 4)}', f'_{rng.randint(1, 99999):05}'])
+        batch.append({
+            'name': f'{words}{tag}.{ext}',
+            'size': int(rng.lognormvariate(13, 2)),
+            'mime_type': mime_type,
+            'telegram_id': i + 1,
+            'chat_id': 1,
+            'folder_id': rng.choice(folders + [None]),
+            'created_at': start + timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 8)),
+        })
+        if len(batch) == 50000:
+            db.session.execute(insert(File), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(File), batch)
+    # A couple of needles for the 'rare' query
+    db.session.execute(insert(File), [{'name': 'thesis-final-2019.pdf', 'size': 1, 'telegram_id': count + 1, 'chat_id': 1}])
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return result, statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with app.app_context():
+        t0 = time.perf_counter()
+        seed(args.files, args.seed)
+        print(f"seeded {args.files} files in {time.perf_counter() - t0:.1f}s, search backend: {search.backend()}")
+
+    client = app.test_client()
+    print(f"{'query':14} {'hits':>5} {'p50':>9} {'p99':>9}   {'LIKE p50':>9}")
+    for label, params in QUERIES:
+        def run():
+            response = client.get('/api/search', query_string=params)
+            assert response.status_code == 200, response.get_data(as_text=True)
+            return response.get_json()
+        data, p50, p99 = timed(run, args.repeat)
+        line = f"{label:14} {len(data['items']):5} {p50:7.1f}ms {p99:7.1f}ms"
+        if params.get('q'):
+            with app.app_context():
+                def scan():
+                    query = File.query
+                    for term in params['q'].split():
+                        query = query.filter(func.lower(File.name).like(f'%{term.lower()}%'))
+                    return query.order_by(File.name, File.id).limit(100).all()
+                _, like_p50, _ = timed(scan, max(1, args.repeat // 4))
+            line += f"   {like_p50:7.1f}ms"
+        print(line)
+
+    # A later page costs the same as the first
+    first = client.get('/api/search', query_string={'q': 'report'}).get_json()
+    _, p50, p99 = timed(lambda: client.get('/api/search', query_string={'q': 'report', 'cursor': first['next_cursor']}), args.repeat)
+    print(f"{'page 2':14} {'':5} {p50:7.1f}ms {p99:7.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Aggregate upload throughput over several storage targets, per placement policy.
+
+Each fake account gets its own sender pool whose connections share one
+pipe of --bandwidth-mb MB/s, standing in for a per-account limit. A batch
+of files with mixed sizes is uploaded through TelegramService with every
+policy, first on one account and then on --accounts of them.
+
+    python -m benchmarks.sharding [--accounts 3] [--files 24] [--concurrency 6]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('API_ID', '')
+
+from benchmarks.fakes import FakeSenderPool, FakeTelegramClient
+from config import Config
+from storage import POLICIES, StorageTarget, make_policy
+from telegram_service import TelegramService
+
+
+def make_files(count, min_mb, max_mb, seed):
+    rng = random.Random(seed)
+    folder = tempfile.mkdtemp()
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'file-{i}.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(int(rng.uniform(min_mb, max_mb) * 1024 * 1024)))
+        paths.append(path)
+    return paths
+
+
+def run(policy, accounts, args):
+    service = TelegramService()
+    service.limits['upload'] = args.concurrency
+    service.placement = make_policy(policy, args.large_mb * 1024 * 1024)
+    targets = []
+    for i in range(accounts):
+        client = FakeTelegramClient(chat_id=1000 + i)
+        targets.append(StorageTarget(f'account{i}', client, 'me'))
+        service.upload_pools[f'account{i}'] = FakeSenderPool(
+            client, Config.UPLOAD_WORKERS, shared_pipe=True,
+            latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024
+        )
+    service.start(targets=targets)
+    service.ready_event.wait(10)
+
+    paths = make_files(args.files, args.min_mb, args.max_mb, args.seed)
+    total = sum(os.path.getsize(path) for path in paths)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(service.upload_file, paths))
+    elapsed = time.perf_counter() - t0
+
+    spread = ' '.join(f"{t.uploads}/{t.bytes_uploaded / 1024 / 1024:.0f}MB" for t in service.targets)
+    print(f"{policy:13} accounts={accounts}  {elapsed:6.2f}s  {total / elapsed / 1024 / 1024:6.1f} MB/s  per target: {spread}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=3)
+    parser.add_argument('--files', type=int, default=24)
+    parser.add_argument('--min-mb', type=float, default=1)
+    parser.add_argument('--max-mb', type=float, default=12)
+    parser.add_argument('--large-mb', type=float, default=6, help="size_aware threshold")
+    parser.add_argument('--concurrency', type=int, default=6, help="uploads running at once")
+    parser.add_argument('--bandwidth-mb', type=float, default=8, help="per account")
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Every file goes through the parallel part uploader and so the fake pipes
+    Config.PARALLEL_UPLOAD_THRESHOLD = 0
+    for policy in POLICIES:
+        for accounts in sorted({1, args.accounts}):
+            run(policy, accounts, args)
+
+
+if __name__ == '__main__':
+    main()
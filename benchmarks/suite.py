@@ -0,0 +1,493 @@
+"""Load scenarios driven through the Flask app against the fake Telegram backend.
+
+Scenarios:
+- uploads: concurrent /upload posts until every file is stored
+- downloads: concurrent /download of large files, with the disk cache off
+- listing: the dashboard and /api/folders/<id>/items paging over 100k files
+- bulk_delete: /delete_folder on a big tree
+- folder_zips: concurrent /download_folder archives, more of them than
+  download slots, each checked for every file
+
+Each scenario runs in its own process, on a fresh SQLite database and
+upload/cache folders in a temp directory. So peak RSS is that scenario's
+own, and nothing left by one run (or by the dev setup) skews the next.
+Telegram is FakeTelegramClient plus FakeSender pools. They have a fixed
+latency and a per-account bandwidth, and FloodWaits are injected at
+--flood-rate. All randomness is seeded.
+
+Every run writes a JSON report with the parameters, commit and machine;
+--compare prints how a run moved against an older report.
+
+    python -m benchmarks.suite [--scenario uploads downloads listing bulk_delete]
+        [--quick] [--output report.json] [--compare old.json]
+"""
+import argparse
+import concurrent.futures
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+BACKEND = {'latency': 0.05, 'bandwidth_mb': 8, 'flood_rate': 0.01, 'flood_seconds': 1, 'seed': 1}
+SCENARIO_PARAMS = {
+    'uploads': {'clients': 8, 'files': 64, 'size_kb': 4096, 'timeout': 600},
+    'downloads': {'clients': 4, 'files': 8, 'size_mb': 32},
+    'listing': {'files': 100000, 'pages': 50, 'repeat': 20},
+    'bulk_delete': {'files': 20000, 'folders': 50, 'repeat': 3},
+    'folder_zips': {'clients': 6, 'files': 8, 'size_kb': 2048, 'timeout': 300},
+}
+QUICK_PARAMS = {
+    'uploads': {'clients': 4, 'files': 16, 'size_kb': 1024},
+    'downloads': {'clients': 2, 'files': 4, 'size_mb': 8},
+    'listing': {'files': 10000, 'pages': 10, 'repeat': 5},
+    'bulk_delete': {'files': 2000, 'repeat': 2},
+    'folder_zips': {'clients': 4, 'files': 4, 'size_kb': 4096, 'timeout': 60},
+}
+# Extra environment per scenario; downloads should measure Telegram, not the cache.
+# Archives get fewer download slots than there are of them, ask to prefetch more, and
+# hold files bigger than a download's buffer.
+SCENARIO_ENV = {
+    'downloads': {'CACHE_MAX_BYTES': '0'},
+    'folder_zips': {'CACHE_MAX_BYTES': '0', 'DOWNLOAD_CONCURRENCY': '2', 'FOLDER_ZIP_PREFETCH': '4',
+                    'DOWNLOAD_BUFFER_CHUNKS': '2'},
+}
+# What --compare reports, and whether bigger is better
+COMPARED = {'p50_ms': False, 'p99_ms': False, 'mb_per_s': True, 'rows_per_s': True, 'peak_rss_mb': False}
+
+
+def summarize(samples):
+    """Count, p50, p99 and max of durations in seconds, as milliseconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+
+    def rank(q):
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)] * 1000
+
+    return {'count': len(ordered), 'p50_ms': round(rank(0.5), 2), 'p99_ms': round(rank(0.99), 2),
+            'max_ms': round(ordered[-1] * 1000, 2)}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (MB if sys.platform == 'darwin' else 1024), 1) # bytes on macOS, KiB elsewhere
+
+
+def flood_waits():
+    import metrics
+    return sum(metrics.FLOOD_WAITS.values.values())
+
+
+# --- Scenarios, each run in a child process -------------------------------
+
+def start_backend(params):
+    from app import app, telegram_service
+    from benchmarks.fakes import FAKE_DC_ID, FakeSenderPool, FakeTelegramClient
+    from config import Config
+    from storage import DEFAULT_ACCOUNT
+
+    options = {
+        'latency': params['latency'],
+        'bandwidth': params['bandwidth_mb'] * MB,
+        'flood_rate': params['flood_rate'],
+        'flood_seconds': params['flood_seconds'],
+    }
+    client = FakeTelegramClient(seed=params['seed'], **options)
+    # One account: its connections share one pipe
+    telegram_service.upload_pools[DEFAULT_ACCOUNT] = FakeSenderPool(
+        client, max(1, Config.UPLOAD_WORKERS), shared_pipe=True, **options)
+    telegram_service.download_pools[(DEFAULT_ACCOUNT, FAKE_DC_ID)] = FakeSenderPool(
+        client, max(1, Config.DOWNLOAD_WORKERS), shared_pipe=True, **options)
+    telegram_service.start(app, client=client)
+    if not telegram_service.ready_event.wait(30):
+        raise Exception("Telegram service did not start")
+    return app, client
+
+
+def seed_tree(folders, files, size=1024, telegram_ids=None, chat_id=777):
+    """A folder tree of `folders` under one root, with `files` rows spread over it."""
+    from sqlalchemy import insert
+    from database import db, File, Folder, FolderStats
+
+    root = Folder(name='bench')
+    db.session.add(root)
+    db.session.flush()
+    folder_ids = [root.id]
+    for i in range(folders - 1):
+        folder = Folder(name=f'folder-{i:04}', parent_id=folder_ids[i // 2])
+        db.session.add(folder)
+        db.session.flush()
+        folder_ids.append(folder.id)
+    start = datetime(2020, 1, 1).timestamp()
+    for first in range(0, files, 50000):
+        db.session.execute(insert(File), [
+            {
+                'name': f'file-{i:07}.bin',
+                'size': size,
+                'mime_type': 'application/octet-stream',
+                'telegram_id': telegram_ids[i] if telegram_ids else i + 1,
+                'chat_id': chat_id,
+                'folder_id': folder_ids[i % len(folder_ids)],
+                'created_at': datetime.fromtimestamp(start + i * 60),
+            }
+            for i in range(first, min(first + 50000, files))
+        ])
+    db.session.commit()
+    FolderStats.recompute()
+    return folder_ids
+
+
+def uploads(params):
+    from database import File
+
+    app, _ = start_backend(params)
+    size = params['size_kb'] * 1024
+    posted = {}
+
+    def post(i):
+        # Random bytes, made per request so they aren't all held at once:
+        # no two files deduplicate and none is worth compressing
+        payload = random.Random(params['seed'] * 100003 + i).randbytes(size)
+        name = f'upload-{i:05}.bin'
+        posted[name] = t0 = time.perf_counter()
+        response = app.test_client().post('/upload', data={
+            'file': (io.BytesIO(payload), name), 'task_id': f'bench-{i}', 'folder_id': 'None'
+        })
+        return time.perf_counter() - t0, response.status_code
+
+    # End to end: from posting until the row points at a message
+    done = {}
+
+    def poll(until):
+        while len(done) < params['files'] and time.perf_counter() < until:
+            with app.app_context():
+                for (name,) in File.query.with_entities(File.name).filter(File.telegram_id != 0):
+                    done.setdefault(name, time.perf_counter())
+            time.sleep(0.02)
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(params['clients'] + 1) as pool:
+        poller = pool.submit(poll, t0 + params['timeout'])
+        results = list(pool.map(post, range(params['files'])))
+        poller.result()
+    elapsed = max(done.values(), default=t0) - t0
+    return {
+        'latency': summarize([elapsed for elapsed, status in results if status < 300]),
+        'end_to_end': summarize([done[name] - posted[name] for name in done]),
+        'mb_per_s': round(len(done) * size / MB / elapsed, 2) if elapsed else None,
+        'files_per_s': round(len(done) / elapsed, 2) if elapsed else None,
+        'errors': params['files'] - len(done),
+        'flood_waits': flood_waits(),
+    }
+
+
+def downloads(params):
+    from sqlalchemy import insert
+    from database import db, File
+
+    app, client = start_backend(params)
+    size = params['size_mb'] * MB
+    # The fake keeps stored media in memory; one shared payload keeps that out of the RSS
+    payload = random.Random(params['seed']).randbytes(size)
+    with app.app_context():
+        messages = [client.store(payload) for _ in range(params['files'])]
+        db.session.execute(insert(File), [
+            {'name': f'download-{i:03}.bin', 'size': size, 'mime_type': 'application/octet-stream',
+             'telegram_id': msg.id, 'chat_id': msg.chat_id}
+            for i, msg in enumerate(messages)
+        ])
+        db.session.commit()
+        file_ids = [file_id for (file_id,) in db.session.query(File.id).order_by(File.id)]
+
+    def fetch(file_id):
+        t0 = time.perf_counter()
+        response = app.test_client().get(f'/download/{file_id}', buffered=False)
+        first_byte, received = None, 0
+        try:
+            for chunk in response.response:
+                if first_byte is None:
+                    first_byte = time.perf_counter() - t0
+                received += len(chunk)
+        finally:
+            response.close()
+        return first_byte, time.perf_counter() - t0, received == size
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(params['clients']) as pool:
+        results = list(pool.map(fetch, file_ids))
+    elapsed = time.perf_counter() - t0
+    complete = [result for result in results if result[2]]
+    return {
+        'latency': summarize([total for _, total, _ in complete]),
+        'first_byte': summarize([first for first, _, _ in complete if first is not None]),
+        'mb_per_s': round(len(complete) * size / MB / elapsed, 2),
+        'errors': len(results) - len(complete),
+        'flood_waits': flood_waits(),
+    }
+
+
+def listing(params):
+    from app import app
+
+    with app.app_context():
+        t0 = time.perf_counter()
+        folder_ids = seed_tree(1, params['files'])
+        seeded = time.perf_counter() - t0
+    folder_id = folder_ids[0]
+    client = app.test_client()
+
+    def timed(url, **query):
+        t0 = time.perf_counter()
+        response = client.get(url, query_string=query)
+        assert response.status_code == 200, response.status_code
+        return time.perf_counter() - t0, response
+
+    dashboard = [timed(f'/dashboard/{folder_id}')[0] for _ in range(params['repeat'])]
+    newest = [timed(f'/dashboard/{folder_id}', sort='created_at', order='desc')[0] for _ in range(params['repeat'])]
+    pages, rows, cursor = [], 0, None
+    for _ in range(params['pages']):
+        elapsed, response = timed(f'/api/folders/{folder_id}/items', **({'cursor': cursor} if cursor else {}))
+        data = response.get_json()
+        pages.append(elapsed)
+        rows += len(data['items'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    return {
+        'latency': summarize(dashboard),
+        'dashboard_newest': summarize(newest),
+        'api_page': summarize(pages),
+        'rows_per_s': round(rows / sum(pages), 1) if pages else None,
+        'seed_s': round(seeded, 2),
+        'errors': 0,
+    }
+
+
+def bulk_delete(params):
+    from database import File, Folder
+
+    app, client = start_backend(params)
+    http = app.test_client()
+    times, left = [], 0
+    for _ in range(params['repeat']):
+        with app.app_context():
+            ids = [client.store(b'x').id for _ in range(params['files'])]
+            root_id = seed_tree(params['folders'], params['files'], size=1, telegram_ids=ids, chat_id=client.chat_id)[0]
+        t0 = time.perf_counter()
+        response = http.post(f'/delete_folder/{root_id}')
+        times.append(time.perf_counter() - t0)
+        assert response.status_code == 302, response.status_code
+        # The request returns once Telegram confirmed the deletes, so this is all of it
+        with app.app_context():
+            left += File.query.count() + Folder.query.count()
+        left += len(client.messages)
+    return {
+        'latency': summarize(times),
+        'rows_per_s': round(params['files'] * len(times) / sum(times), 1),
+        'errors': left, # rows or messages left behind
+        'flood_waits': flood_waits(),
+    }
+
+
+def folder_zips(params):
+    app, client = start_backend(params)
+    size = params['size_kb'] * 1024
+    payload = random.Random(params['seed']).randbytes(size)
+    with app.app_context():
+        roots = []
+        for _ in range(params['clients']):
+            ids = [client.store(payload).id for _ in range(params['files'])]
+            roots.append(seed_tree(1, params['files'], size=size, telegram_ids=ids, chat_id=client.chat_id)[0])
+
+    results = {}
+
+    def fetch(root_id):
+        t0 = time.perf_counter()
+        response = app.test_client().get(f'/download_folder/{root_id}')
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        files = [info for info in archive.infolist() if not info.is_dir()]
+        complete = (len(files) == params['files'] and archive.testzip() is None
+                    and all(archive.read(info) == payload for info in files))
+        results[root_id] = (time.perf_counter() - t0, complete)
+
+    # Daemon threads, so archives that never finish show up as errors instead of hanging the run
+    threads = [threading.Thread(target=fetch, args=(root_id,), daemon=True) for root_id in roots]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(t0 + params['timeout'] - time.perf_counter(), 0))
+    elapsed = time.perf_counter() - t0
+    complete = [total for total, ok in results.values() if ok]
+    return {
+        'latency': summarize(complete),
+        'mb_per_s': round(len(complete) * params['files'] * size / MB / elapsed, 2),
+        'errors': len(roots) - len(complete),
+        'flood_waits': flood_waits(),
+    }
+
+
+SCENARIOS = {'uploads': uploads, 'downloads': downloads, 'listing': listing, 'bulk_delete': bulk_delete,
+             'folder_zips': folder_zips}
+
+
+def child(name, params, result_path):
+    t0 = time.perf_counter()
+    result = SCENARIOS[name](params)
+    result['wall_s'] = round(time.perf_counter() - t0, 2)
+    result['peak_rss_mb'] = peak_rss_mb()
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+# --- Driver ---------------------------------------------------------------
+
+def run_scenario(name, params):
+    workdir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    env = dict(os.environ, **SCENARIO_ENV.get(name, {}))
+    env.update({
+        'API_ID': '',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'CACHE_FOLDER': os.path.join(workdir, 'cache'),
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')])),
+    })
+    result_path = os.path.join(workdir, 'result.json')
+    log_path = os.path.join(workdir, 'output.log')
+    with open(log_path, 'w') as log:
+        # The workdir is the cwd too, so telegram_service.log lands there
+        proc = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.suite', '--child', name, '--params', json.dumps(params), '--result', result_path],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    if proc.returncode or not os.path.exists(result_path):
+        with open(log_path) as f:
+            tail = f.read()[-3000:]
+        raise Exception(f"Scenario {name} failed (exit {proc.returncode}); output kept in {workdir}:\n{tail}")
+    with open(result_path) as f:
+        result = json.load(f)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_result(name, result):
+    line = f"{name:12}"
+    latency = result.get('latency', {})
+    if latency.get('count'):
+        line += f" p50 {latency['p50_ms']:9.1f}ms  p99 {latency['p99_ms']:9.1f}ms"
+    for key, unit in (('mb_per_s', 'MB/s'), ('rows_per_s', 'rows/s'), ('files_per_s', 'files/s')):
+        if result.get(key) is not None:
+            line += f"  {result[key]:9.1f} {unit}"
+    line += f"  rss {result['peak_rss_mb']}MB  errors {result['errors']}"
+    if result.get('flood_waits'):
+        line += f"  floodwaits {result['flood_waits']}"
+    print(line)
+    for key, value in result.items():
+        if isinstance(value, dict) and key != 'latency' and value.get('count'):
+            print(f"  {key:22} p50 {value['p50_ms']:9.1f}ms  p99 {value['p99_ms']:9.1f}ms  ({value['count']})")
+
+
+def compare(old, new):
+    """Prints the change of each COMPARED number between two reports."""
+    print(f"\nagainst {old.get('commit')} of {old.get('created_at')}:")
+    if old.get('backend') != new.get('backend'):
+        print("  (backend settings differ, numbers are not comparable)")
+    for name, result in new['scenarios'].items():
+        before = old.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        if before.get('params') != result.get('params'):
+            print(f"  {name}: parameters differ, skipped")
+            continue
+        for key, higher_is_better in COMPARED.items():
+            a = before.get('latency', {}).get(key) if key.endswith('_ms') else before.get(key)
+            b = result.get('latency', {}).get(key) if key.endswith('_ms') else result.get(key)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            better = change > 0 if higher_is_better else change < 0
+            verdict = 'better' if better and abs(change) >= 0.05 else 'worse' if abs(change) >= 0.05 else ''
+            print(f"  {name:12} {key:12} {a:10.1f} -> {b:10.1f}  {change:+7.1%} {verdict}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--quick', action='store_true', help="smaller sizes, for a smoke run")
+    parser.add_argument('--latency', type=float, default=BACKEND['latency'], help="seconds per fake Telegram call")
+    parser.add_argument('--bandwidth-mb', type=float, default=BACKEND['bandwidth_mb'], help="per account, MB/s")
+    parser.add_argument('--flood-rate', type=float, default=BACKEND['flood_rate'], help="share of calls getting a FloodWait")
+    parser.add_argument('--flood-seconds', type=int, default=BACKEND['flood_seconds'])
+    parser.add_argument('--seed', type=int, default=BACKEND['seed'])
+    parser.add_argument('--output', help="report path (default benchmarks/reports/<time>-<commit>.json)")
+    parser.add_argument('--compare', help="an earlier report to compare with")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, json.loads(args.params), args.result)
+        return
+
+    backend = {'latency': args.latency, 'bandwidth_mb': args.bandwidth_mb, 'flood_rate': args.flood_rate,
+               'flood_seconds': args.flood_seconds, 'seed': args.seed}
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'backend': backend,
+        'scenarios': {},
+    }
+    print(f"latency {args.latency * 1000:.0f}ms, {args.bandwidth_mb} MB/s per account, "
+          f"FloodWait on {args.flood_rate:.1%} of calls")
+    for name in args.scenario:
+        params = dict(SCENARIO_PARAMS[name], **(QUICK_PARAMS[name] if args.quick else {}))
+        result = run_scenario(name, dict(backend, **params))
+        report['scenarios'][name] = dict(result, params=params)
+        print_result(name, result)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'reports', f"{datetime.now():%Y%m%d-%H%M%S}-{report['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Throughput of the parallel transfer engine against fake MTProto senders.
+
+Each fake sender models one connection with a fixed bandwidth and round
+trip, so the numbers show how throughput scales with the worker count.
+
+    python -m benchmarks.transfer_throughput [--mode upload|download|both]
+        [--size-mb 32] [--workers 1 2 4 8] [--chunk-kb 512]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from telethon import types
+
+from benchmarks.fakes import FakeSender
+from transfer import ParallelDownloader, ParallelUploader
+
+
+async def _chunks(data, part_size):
+    for i in range(0, len(data), part_size):
+        yield data[i:i + part_size]
+
+
+async def bench_upload(data, workers, args):
+    store = {}
+    senders = [
+        FakeSender(args.latency, args.bandwidth_mb * 1024 * 1024, args.fail_rate, store, seed=i)
+        for i in range(workers)
+    ]
+    uploader = ParallelUploader(senders, retries=5)
+    t0 = time.perf_counter()
+    result = await uploader.upload(_chunks(data, uploader.part_size), len(data), 'bench.bin')
+    elapsed = time.perf_counter() - t0
+
+    parts = sorted((part, payload) for (file_id, part), payload in store.items() if file_id == result.id)
+    assert b''.join(payload for _, payload in parts) == data, "reassembled upload does not match"
+    return elapsed
+
+
+async def bench_download(data, workers, args):
+    documents = {1: data}
+    senders = [
+        FakeSender(args.latency, args.bandwidth_mb * 1024 * 1024, args.fail_rate, documents=documents, seed=i)
+        for i in range(workers)
+    ]
+    downloader = ParallelDownloader(senders, chunk_size=args.chunk_kb * 1024, retries=5)
+    location = types.InputDocumentFileLocation(id=1, access_hash=0, file_reference=b'', thumb_size='')
+    t0 = time.perf_counter()
+    received = bytearray()
+    async for chunk in downloader.iter_range(location, 0, len(data)):
+        received += chunk
+    elapsed = time.perf_counter() - t0
+    assert bytes(received) == data, "reassembled download does not match"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--latency', type=float, default=0.05, help="round trip per request, seconds")
+    parser.add_argument('--bandwidth-mb', type=float, default=4, help="per-connection bandwidth, MB/s")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument('--chunk-kb', type=int, default=512, help="download chunk size, KiB")
+    parser.add_argument('--mode', choices=['upload', 'download', 'both'], default='both')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    benches = {'upload': bench_upload, 'download': bench_download}
+    for mode, bench in benches.items():
+        if args.mode not in (mode, 'both'):
+            continue
+        for workers in args.workers:
+            elapsed = asyncio.run(bench(data, workers, args))
+            print(f"{mode:8} workers={workers:<2} {args.size_mb / elapsed:8.2f} MB/s  ({elapsed:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
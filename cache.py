@@ -0,0 +1,196 @@
+"""Local read-through cache for files downloaded from Telegram.
+
+Entries live as plain files under one directory, so the cache survives
+restarts and hits can be served with send_file at disk speed. Size and
+entry count are bounded; the least recently used entries go first.
+
+The directory is the only index: lookups stat the entry's file, and
+eviction lists the directory under a file lock. So all gunicorn workers
+can share one cache, each seeing what the others stored or evicted.
+"""
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows: only threads of one process are kept apart
+    fcntl = None
+
+PARTIAL_SUFFIX = '.part'
+LOCK_NAME = '.lock'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # alive, owned by someone else
+    return True
+
+
+class DiskCache:
+    def __init__(self, root, max_bytes, max_entries):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # This process's own counts
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.root, exist_ok=True)
+        with self._exclusive():
+            for name in os.listdir(self.root):
+                if not name.endswith(PARTIAL_SUFFIX):
+                    continue
+                # Left over from a download interrupted by a restart; other
+                # workers' downloads still being written are left alone
+                pid = name[:-len(PARTIAL_SUFFIX)].rsplit('.', 2)[-2]
+                if pid.isdigit() and _pid_alive(int(pid)):
+                    continue
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    @contextmanager
+    def _exclusive(self):
+        """Held while the directory is changed as a whole, by one thread of one process."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, LOCK_NAME), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX) # released on close
+                yield
+
+    def _scan(self):
+        """(mtime, key, size) of the stored entries, least recently used first."""
+        found = []
+        for entry in os.scandir(self.root):
+            # Temp files and the lock file are dot names; keys never are
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue # evicted meanwhile
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        return sorted(found)
+
+    def get(self, key):
+        """Returns the cached file's path, or None on a miss."""
+        path = self._path(key)
+        try:
+            # mtime carries the LRU order, across workers and restarts
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def can_store(self, size):
+        return size is not None and 0 < size <= self.max_bytes
+
+    def writer(self, key, size):
+        """Returns a CacheWriter that adds `key` once all `size` bytes are written."""
+        return CacheWriter(self, key, size)
+
+    def _commit(self, key, temp_path, size):
+        # Atomic: readers see either no entry or the complete file
+        os.replace(temp_path, self._path(key))
+        with self._exclusive():
+            self._evict()
+
+    def _evict(self):
+        entries = self._scan()
+        count = len(entries)
+        total_bytes = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if total_bytes <= self.max_bytes and count <= self.max_entries:
+                break
+            try:
+                os.remove(self._path(key))
+                self.evictions += 1
+            except OSError:
+                pass
+            count -= 1
+            total_bytes -= size
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        entries = self._scan()
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, _, size in entries),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class CacheWriter:
+    """Collects one download into a temp file next to the cache entries."""
+
+    def __init__(self, cache, key, size):
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.written = 0
+        # The pid tells a starting worker whether the download is still going on
+        self.temp_path = os.path.join(cache.root, f".{key}.{os.getpid()}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}")
+        self._file = None
+
+    def write(self, data):
+        if self._file is None:
+            self._file = open(self.temp_path, 'wb')
+        self._file.write(data)
+        self.written += len(data)
+
+    def commit(self):
+        if self._file is None or self.written != self.size:
+            self.abort()
+            return
+        self._file.close()
+        self.cache._commit(self.key, self.temp_path, self.size)
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def tee(self, chunks):
+        """Passes `chunks` through, keeping the entry only if they all arrive."""
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                yield chunk
+        except BaseException:
+            self.abort()
+            raise
+        self.commit()
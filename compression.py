@@ -0,0 +1,108 @@
+"""Optional compression of staged uploads.
+
+Uploads whose type and content look compressible are compressed while
+they are staged, so fewer bytes go to Telegram; File.codec records how,
+and downloads decompress on the way out. File.size and File.sha256 stay
+those of the original content.
+
+zstd is used when the zstandard package is installed, zlib otherwise.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Appended to the staged file's name, and so to the Telegram message's
+EXTENSIONS = {'zlib': '.zz', 'zstd': '.zst'}
+
+# Formats that are compressed already; sampling would say so too, this just saves the work
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/')
+INCOMPRESSIBLE_SUBTYPES = (
+    'zip', 'gzip', 'x-gzip', 'zstd', 'x-bzip2', 'x-xz', 'x-7z-compressed', 'vnd.rar', 'x-rar-compressed',
+    'pdf', 'epub+zip', 'java-archive', 'vnd.android.package-archive',
+    'vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'vnd.openxmlformats-officedocument.presentationml.presentation',
+)
+
+
+def default_codec():
+    return 'zstd' if zstandard else 'zlib'
+
+
+def compressor(codec, level=None):
+    """A streaming compressor: .compress(data) and a final .flush() return bytes."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level or 3).compressobj()
+    if codec == 'zlib':
+        return zlib.compressobj(level or 6)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception("This file is zstd compressed; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def worth_compressing(sample, mime_type=None, min_ratio=0.9):
+    """Whether content starting with `sample` is likely to shrink by at least 1 - min_ratio."""
+    if mime_type:
+        mime_type = mime_type.lower()
+        if mime_type.startswith(INCOMPRESSIBLE_TYPES) or mime_type.partition('/')[2] in INCOMPRESSIBLE_SUBTYPES:
+            return False
+    if not sample:
+        return False
+    # A fast trial on the sample; the real pass uses the configured level
+    return len(zlib.compress(sample, 1)) <= len(sample) * min_ratio
+
+
+def decompress_stream(chunks, codec, offset=0, length=None):
+    """An iterator of the decompressed bytes of `chunks`, `length` of them from `offset`.
+
+    Compressed data can't be entered in the middle, so a range still reads
+    everything before it. Closing the iterator closes `chunks`, even before
+    anything was read.
+    """
+    stream = _decompress(chunks, codec, offset, length)
+    next(stream) # into the try, so close() always gets to the finally
+    return stream
+
+
+def _decompress(chunks, codec, offset, length):
+    inflater = decompressor(codec)
+    end = None if length is None else offset + length
+    position = 0
+
+    def window(data):
+        # The part of `data`, which starts at `position`, that lies in the range
+        nonlocal position
+        start, position = position, position + len(data)
+        data = data[max(offset - start, 0):]
+        if end is not None:
+            data = data[:max(end - max(start, offset), 0)]
+        return data
+
+    try:
+        yield
+        for chunk in chunks:
+            data = window(inflater.decompress(chunk))
+            if data:
+                yield data
+            if end is not None and position >= end:
+                return
+        data = window(inflater.flush())
+        if data:
+            yield data
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
@@ -25,9 +25,90 @@ class Config:
     PHONE_NUMBER = os.environ.get('PHONE_NUMBER')
     SESSION_STRING = os.environ.get('TELEGRAM_SESSION_STRING')
     SESSION_NAME = 'cloud_backup_v4'
+
+    # Chats files are stored in (see storage.py) and how uploads are spread over them
+    STORAGE_TARGETS = os.environ.get('STORAGE_TARGETS', 'me')
+    STORAGE_POLICY = os.environ.get('STORAGE_POLICY', 'round_robin')
+    STORAGE_LARGE_FILE = int(os.environ.get('STORAGE_LARGE_FILE', 20 * 1024 * 1024))
     
     # Upload/Download Config
-    UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'uploads')
+
+    # Max concurrent Telegram operations per command type
+    UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 2))
+    DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 4))
+    DELETE_CONCURRENCY = int(os.environ.get('DELETE_CONCURRENCY', 2))
+    # Message ids per Telegram delete call (the API allows 100)
+    DELETE_BATCH_SIZE = min(int(os.environ.get('DELETE_BATCH_SIZE', 100)), 100)
+
+    # Local LRU cache of downloaded files
+    CACHE_FOLDER = os.environ.get('CACHE_FOLDER') or os.path.join(UPLOAD_FOLDER, 'cache')
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 500))
+
+    # Unix socket of the Telegram gateway process (gateway.py). Unset, the
+    # client runs inside the web process, which only works with one worker.
+    TELEGRAM_GATEWAY = os.environ.get('TELEGRAM_GATEWAY', '')
+
+    # Browser uploads go straight to Telegram; disk staging (/upload) is the fallback
+    STREAM_UPLOADS = os.environ.get('STREAM_UPLOADS', '1') == '1'
+
+    # Upload progress over SSE: min seconds between pushes, seconds finished
+    # tasks are kept, and max seconds per stream before the browser reconnects
+    PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 0.3))
+    PROGRESS_TTL = int(os.environ.get('PROGRESS_TTL', 300))
+    PROGRESS_STREAM_SECONDS = int(os.environ.get('PROGRESS_STREAM_SECONDS', 25))
+
+    # Files at least this big are uploaded in parallel parts over UPLOAD_WORKERS connections
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+    PARALLEL_UPLOAD_THRESHOLD = int(os.environ.get('PARALLEL_UPLOAD_THRESHOLD', 5 * 1024 * 1024))
+    UPLOAD_PART_RETRIES = int(os.environ.get('UPLOAD_PART_RETRIES', 3))
+
+    # Durable upload jobs: attempts before giving up, backoff base/cap (seconds),
+    # seconds without a sign of life before another worker takes a job over,
+    # and how often resume state is saved while parts go out
+    UPLOAD_JOB_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_JOB_MAX_ATTEMPTS', 5))
+    UPLOAD_JOB_BACKOFF = float(os.environ.get('UPLOAD_JOB_BACKOFF', 5))
+    UPLOAD_JOB_MAX_BACKOFF = float(os.environ.get('UPLOAD_JOB_MAX_BACKOFF', 600))
+    UPLOAD_JOB_LEASE = int(os.environ.get('UPLOAD_JOB_LEASE', 120))
+    UPLOAD_JOB_SAVE_INTERVAL = float(os.environ.get('UPLOAD_JOB_SAVE_INTERVAL', 2))
+
+    # Bytes of storage /api/quota reports usage against; 0 for no quota
+    STORAGE_QUOTA = int(os.environ.get('STORAGE_QUOTA', 0))
+
+    # Staged uploads that look compressible, by type and a trial on their first
+    # MB, are stored compressed if that trial shrinks to COMPRESSION_MIN_RATIO.
+    # UPLOAD_COMPRESSION: 'auto' (zstd if zstandard is installed, else zlib),
+    # 'zstd', 'zlib' or 'off'. COMPRESSION_LEVEL 0 means the codec's default.
+    UPLOAD_COMPRESSION = os.environ.get('UPLOAD_COMPRESSION', 'auto')
+    COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 0))
+    COMPRESSION_MIN_RATIO = float(os.environ.get('COMPRESSION_MIN_RATIO', 0.9))
+
+    # Files bigger than STORAGE_CHUNK_SIZE are stored as several messages of at
+    # most that size (Telegram takes 2000 MB per file, 4000 MB with Premium);
+    # rounded down to whole 512 KB upload parts. Downloads of such files read
+    # up to STORAGE_CHUNK_READ_AHEAD chunks at once.
+    STORAGE_CHUNK_SIZE = max(1, int(os.environ.get('STORAGE_CHUNK_SIZE', 1024 * 1024 * 1024)) // (512 * 1024)) * 512 * 1024
+    STORAGE_CHUNK_READ_AHEAD = int(os.environ.get('STORAGE_CHUNK_READ_AHEAD', 2))
+
+    # Thumbnails made at upload time: longest side in pixels (0 turns them off),
+    # JPEG quality, and how long browsers may cache one
+    THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 320))
+    THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+    THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 365 * 24 * 3600))
+
+    # Folder ZIP downloads: files whose transfer starts while the one before is written
+    # (kept below DOWNLOAD_CONCURRENCY)
+    FOLDER_ZIP_PREFETCH = int(os.environ.get('FOLDER_ZIP_PREFETCH', 2))
+
+    # Streaming downloads: bytes per Telegram request and chunks buffered per download
+    DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 512 * 1024))
+    DOWNLOAD_BUFFER_CHUNKS = int(os.environ.get('DOWNLOAD_BUFFER_CHUNKS', 4))
+
+    # Reads of at least this many bytes fetch chunks in parallel over DOWNLOAD_WORKERS connections
+    DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+    PARALLEL_DOWNLOAD_THRESHOLD = int(os.environ.get('PARALLEL_DOWNLOAD_THRESHOLD', 2 * 1024 * 1024))
+    DOWNLOAD_CHUNK_RETRIES = int(os.environ.get('DOWNLOAD_CHUNK_RETRIES', 3))
 
     # PythonAnywhere Proxy Settings
     IS_PYTHONANYWHERE = os.path.exists('/var/www') and ('pythonanywhere' in os.getcwd().lower() or 'Shanib' in os.getcwd())
@@ -1,18 +1,43 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import BigInteger, inspect, literal, text
 from datetime import datetime
 
 db = SQLAlchemy()
 
 class Folder(db.Model):
     __tablename__ = 'folders'
+    __table_args__ = (
+        # Keyset pagination of a folder's children by (name, id) / (created_at, id)
+        db.Index('ix_folders_parent_name', 'parent_id', 'name', 'id'),
+        db.Index('ix_folders_parent_created', 'parent_id', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     subfolders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), lazy=True)
     files = db.relationship('File', backref='folder', lazy=True)
 
+    @classmethod
+    def with_ancestors(cls, folder_id):
+        """Returns the folder and all its ancestors, root first, in one query."""
+        chain = db.select(cls.id, cls.parent_id, literal(0).label('depth')) \
+            .where(cls.id == folder_id) \
+            .cte('chain', recursive=True)
+        chain = chain.union_all(
+            db.select(cls.id, cls.parent_id, chain.c.depth + 1)
+            .join(chain, cls.id == chain.c.parent_id)
+        )
+        return cls.query.join(chain, cls.id == chain.c.id).order_by(chain.c.depth.desc()).all()
+
+    @classmethod
+    def subtree_ids(cls, folder_id):
+        """A SELECT of the ids of the folder and everything below it, for use in IN (...)."""
+        tree = db.select(cls.id).where(cls.id == folder_id).cte('tree', recursive=True)
+        tree = tree.union_all(db.select(cls.id).join(tree, cls.parent_id == tree.c.id))
+        return db.select(tree.c.id)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -23,14 +48,61 @@ class Folder(db.Model):
 
 class File(db.Model):
     __tablename__ = 'files'
+    __table_args__ = (
+        db.Index('ix_files_folder_name', 'folder_id', 'name', 'id'),
+        db.Index('ix_files_folder_created', 'folder_id', 'created_at', 'id'),
+        # Tree-wide search results, in each of its sort orders
+        db.Index('ix_files_name', 'name', 'id'),
+        db.Index('ix_files_created', 'created_at', 'id'),
+        db.Index('ix_files_size', 'size', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    size = db.Column(db.Integer)
+    size = db.Column(db.BigInteger) # Chunked files go past 2 GB
     mime_type = db.Column(db.String(100))
-    telegram_id = db.Column(db.Integer) # Message ID
-    chat_id = db.Column(db.Integer) # Channel ID or User ID where it lives
-    folder_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
+    telegram_id = db.Column(db.Integer, index=True) # Message ID
+    chat_id = db.Column(db.BigInteger) # Channel ID or User ID where it lives (channel ids exceed 32 bits)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sha256 = db.Column(db.String(64), index=True) # Content hash; identical uploads share one message
+    chunk_count = db.Column(db.Integer) # Set when stored as FileChunk messages; telegram_id is then chunk 0's
+    codec = db.Column(db.String(16)) # 'zlib' or 'zstd' if stored compressed; see compression.py
+    has_thumbnail = db.Column(db.Boolean) # A Thumbnail row exists; saves loading it for every tile
+
+    chunks = db.relationship('FileChunk', order_by='FileChunk.index', lazy=True)
+    thumbnail = db.relationship('Thumbnail', uselist=False, lazy=True)
+
+    @classmethod
+    def find_uploaded(cls, sha256, exclude_id=None):
+        """Returns a file already on Telegram with the given content hash."""
+        query = cls.query.filter(cls.sha256 == sha256, cls.telegram_id != 0)
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+        return query.first()
+
+    def share_storage(self, original):
+        """Points this row at the message(s) `original` is stored in."""
+        self.telegram_id = original.telegram_id
+        self.chat_id = original.chat_id
+        self.chunk_count = original.chunk_count
+        self.codec = original.codec
+        self.chunks = [
+            FileChunk(index=c.index, telegram_id=c.telegram_id, chat_id=c.chat_id, size=c.size, sha256=c.sha256)
+            for c in original.chunks
+        ]
+        if original.has_thumbnail:
+            # Same content, same preview
+            self.thumbnail = original.thumbnail.copy()
+            self.has_thumbnail = True
+
+    def chunk_map(self):
+        """The chunks of a chunked file as TelegramService.open_download takes them, else None."""
+        if not self.chunk_count:
+            return None
+        chunks = [chunk.to_dict() for chunk in self.chunks]
+        if len(chunks) != self.chunk_count:
+            raise Exception(f"File {self.id} has {len(chunks)} of its {self.chunk_count} chunks stored")
+        return chunks
 
     def to_dict(self):
         return {
@@ -40,5 +112,241 @@ class File(db.Model):
             'mime_type': self.mime_type,
             'telegram_id': self.telegram_id,
             'folder_id': self.folder_id,
+            'has_thumbnail': bool(self.has_thumbnail),
             'created_at': self.created_at.isoformat()
         }
+
+class FileChunk(db.Model):
+    """One fixed-size piece of a file too big for a single message."""
+    __tablename__ = 'file_chunks'
+    __table_args__ = (
+        db.UniqueConstraint('file_id', 'index', name='uq_file_chunks_file_index'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), nullable=False)
+    index = db.Column(db.Integer, nullable=False) # Position in the file, from 0
+    telegram_id = db.Column(db.Integer, nullable=False, index=True) # Message ID
+    chat_id = db.Column(db.BigInteger) # Chunks of one file may sit in different storage targets
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64)) # Checked when the whole chunk is read back
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'telegram_id': self.telegram_id,
+            'chat_id': self.chat_id,
+            'size': self.size,
+            'sha256': self.sha256
+        }
+
+class Thumbnail(db.Model):
+    """A small JPEG preview of a file, made once when it is uploaded; see thumbnails.py."""
+    __tablename__ = 'thumbnails'
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), primary_key=True, autoincrement=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    source = db.Column(db.String(16)) # 'image' if scaled from the upload, 'telegram' if Telegram's own
+
+    def copy(self):
+        return Thumbnail(data=self.data, width=self.width, height=self.height, source=self.source)
+
+class FolderStats(db.Model):
+    """Totals of the files in a folder and everything below it.
+
+    Kept up to date by adjust() wherever stored files are added or
+    removed, so sizes and usage are one row read instead of a walk over
+    the tree; recompute() repairs drift. Only files that made it to
+    Telegram (telegram_id != 0) count. Row ROOT holds the whole tree.
+    """
+    __tablename__ = 'folder_stats'
+    ROOT = 0
+    folder_id = db.Column(db.Integer, primary_key=True, autoincrement=False) # Folder.id, or ROOT
+    file_count = db.Column(db.Integer, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    last_modified = db.Column(db.DateTime) # Last time a file was added or removed below
+
+    @classmethod
+    def _ancestors(cls, folder_ids=None):
+        """A SELECT of (folder_id, ancestor_id) pairs, each folder counting as its own ancestor.
+
+        Covers the given folders, or all of them.
+        """
+        up = db.select(Folder.id.label('folder_id'), Folder.id.label('ancestor_id'))
+        if folder_ids is not None:
+            up = up.where(Folder.id.in_(folder_ids))
+        up = up.cte('up', recursive=True)
+        up = up.union_all(
+            db.select(up.c.folder_id, Folder.parent_id)
+            .join(Folder, Folder.id == up.c.ancestor_id)
+            .where(Folder.parent_id.isnot(None))
+        )
+        return db.select(up.c.folder_id, up.c.ancestor_id)
+
+    @classmethod
+    def adjust(cls, changes):
+        """Applies {folder_id: (files, bytes)} deltas to each folder, its ancestors and ROOT.
+
+        folder_id None stands for the top level. Two queries plus one
+        UPDATE per affected row, however many files changed. The caller commits.
+        """
+        totals = {cls.ROOT: [0, 0]}
+        for files, size in changes.values():
+            totals[cls.ROOT][0] += files
+            totals[cls.ROOT][1] += size
+        folder_ids = [folder_id for folder_id in changes if folder_id is not None]
+        if folder_ids:
+            for folder_id, ancestor_id in db.session.execute(cls._ancestors(folder_ids)):
+                files, size = changes[folder_id]
+                total = totals.setdefault(ancestor_id, [0, 0])
+                total[0] += files
+                total[1] += size
+
+        now = datetime.utcnow()
+        existing = {row.folder_id for row in db.session.query(cls.folder_id).filter(cls.folder_id.in_(totals))}
+        for folder_id, (files, size) in totals.items():
+            if folder_id in existing:
+                # Relative updates, so concurrent adjustments add up
+                db.session.execute(db.update(cls).where(cls.folder_id == folder_id).values(
+                    file_count=cls.file_count + files,
+                    total_bytes=cls.total_bytes + size,
+                    last_modified=now
+                ))
+            else:
+                db.session.add(cls(folder_id=folder_id, file_count=files, total_bytes=size, last_modified=now))
+
+    @classmethod
+    def file_changes(cls, condition, sign=1):
+        """adjust() deltas for the stored files matching `condition`, negated with sign=-1."""
+        rows = db.session.query(File.folder_id, db.func.count(File.id), db.func.coalesce(db.func.sum(File.size), 0)) \
+            .filter(condition, File.telegram_id != 0) \
+            .group_by(File.folder_id)
+        return {folder_id: (sign * files, sign * size) for folder_id, files, size in rows}
+
+    @classmethod
+    def recompute(cls):
+        """Rebuilds every row from the files table; returns the ids of the rows that were off."""
+        direct = db.select(
+            File.folder_id,
+            db.func.count(File.id).label('files'),
+            db.func.coalesce(db.func.sum(File.size), 0).label('size'),
+            db.func.max(File.created_at).label('modified')
+        ).where(File.telegram_id != 0).group_by(File.folder_id).subquery()
+        up = cls._ancestors().subquery()
+        rolled_up = db.session.execute(
+            db.select(
+                up.c.ancestor_id,
+                db.func.sum(direct.c.files),
+                db.func.sum(direct.c.size),
+                db.func.max(direct.c.modified)
+            ).join(direct, direct.c.folder_id == up.c.folder_id).group_by(up.c.ancestor_id)
+        ).all()
+        root = db.session.execute(
+            db.select(db.func.sum(direct.c.files), db.func.sum(direct.c.size), db.func.max(direct.c.modified))
+        ).one()
+
+        fresh = {folder_id: (0, 0, None) for (folder_id,) in db.session.execute(db.select(Folder.id))}
+        fresh[cls.ROOT] = (int(root[0] or 0), int(root[1] or 0), root[2])
+        for folder_id, files, size, modified in rolled_up:
+            fresh[folder_id] = (int(files), int(size), modified)
+
+        old = {row.folder_id: (row.file_count, row.total_bytes) for row in cls.query}
+        off = [folder_id for folder_id, values in fresh.items() if old.get(folder_id) != values[:2]]
+        off += [folder_id for folder_id in old if folder_id not in fresh]
+        cls.query.delete()
+        db.session.add_all(
+            cls(folder_id=folder_id, file_count=files, total_bytes=size, last_modified=modified)
+            for folder_id, (files, size, modified) in fresh.items()
+        )
+        db.session.commit()
+        return off
+
+    @classmethod
+    def get(cls, folder_id=None):
+        """The totals of a folder (None for the whole tree), zeros if it has no row yet."""
+        folder_id = cls.ROOT if folder_id is None else folder_id
+        return db.session.get(cls, folder_id) or cls(folder_id=folder_id, file_count=0, total_bytes=0)
+
+    def to_dict(self):
+        return {
+            'folder_id': None if self.folder_id == self.ROOT else self.folder_id,
+            'file_count': self.file_count,
+            'total_bytes': self.total_bytes,
+            'last_modified': self.last_modified.isoformat() if self.last_modified else None
+        }
+
+class UploadJob(db.Model):
+    """A staged upload waiting to be sent to Telegram; see jobs.py."""
+    __tablename__ = 'upload_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), nullable=False, unique=True)
+    path = db.Column(db.String(1024), nullable=False) # Staged copy in UPLOAD_FOLDER
+    task_id = db.Column(db.String(64)) # Browser progress id
+    state = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    part_file_id = db.Column(db.BigInteger) # Telegram upload id the saved parts belong to
+    chat_id = db.Column(db.BigInteger) # Storage target the saved parts were sent for
+    parts_done = db.Column(db.Integer, nullable=False, default=0) # Parts 0..n-1 are acknowledged
+    bytes_uploaded = db.Column(db.BigInteger, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'file_id': self.file_id,
+            'path': self.path,
+            'task_id': self.task_id,
+            'state': self.state,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat(),
+            'part_file_id': self.part_file_id,
+            'chat_id': self.chat_id,
+            'parts_done': self.parts_done,
+            'bytes_uploaded': self.bytes_uploaded,
+            'last_error': self.last_error
+        }
+
+def upgrade_schema():
+    """Brings a database created by an older version up to date.
+
+    create_all() only creates missing tables, so columns and indexes added
+    to existing models since then are added here. New columns must be
+    nullable or carry a server_default. Integer columns since widened to
+    BigInteger are altered too; SQLite integers are 64-bit already.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col['name']: col['type'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    widened = isinstance(column.type, BigInteger) and not isinstance(existing[column.name], BigInteger)
+                    if widened and db.engine.dialect.name == 'postgresql':
+                        conn.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT'))
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                conn.execute(text(ddl))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def prepare_database():
+    """Creates and upgrades the schema and search index; returns the search backend.
+
+    DDL from several processes at once races, so under gunicorn the master
+    runs this once before the workers start and they only connect.
+    """
+    import search
+    db.create_all()
+    upgrade_schema()
+    backend = search.install()
+    if db.session.get(FolderStats, FolderStats.ROOT) is None:
+        # First run with folder stats: work them out once from what is stored
+        FolderStats.recompute()
+    return backend
@@ -0,0 +1,288 @@
+"""Telegram gateway: one process owning the Telegram client for all web workers.
+
+Telethon can't share a session between processes, so with several gunicorn
+workers the client, its connection pools, the upload job scheduler and the
+progress store live here instead. Workers reach it through GatewayClient,
+which has the same interface app.py uses on TelegramService, over a Unix
+socket at Config.TELEGRAM_GATEWAY.
+
+Each call is one connection. Frames are a kind byte, a 4-byte big-endian
+length and the payload: b'J' JSON, b'B' raw bytes, b'E' end of a stream.
+A call sends {"method", "args"} and gets {"result"} or {"error"} back;
+upload_stream then sends the raw body, open_download and stream_progress
+answer with a series of frames up to b'E'.
+
+    python gateway.py    # normally started by gunicorn.conf.py
+"""
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+
+from config import Config
+
+HEADER = struct.Struct('>cI')
+
+
+def send_frame(wfile, kind, payload=b''):
+    wfile.write(HEADER.pack(kind, len(payload)))
+    wfile.write(payload)
+
+
+def send_json(wfile, obj):
+    send_frame(wfile, b'J', json.dumps(obj, default=str).encode())
+
+
+def read_frame(rfile):
+    header = rfile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ConnectionError("Telegram gateway closed the connection")
+    kind, length = HEADER.unpack(header)
+    payload = rfile.read(length)
+    if len(payload) < length:
+        raise ConnectionError("Telegram gateway closed the connection")
+    return kind, payload
+
+
+def read_result(rfile):
+    kind, payload = read_frame(rfile)
+    if kind != b'J':
+        raise ConnectionError(f"Unexpected frame from Telegram gateway: {kind!r}")
+    message = json.loads(payload)
+    if 'error' in message:
+        raise Exception(message['error'])
+    return message.get('result')
+
+
+class GatewayHandler(socketserver.StreamRequestHandler):
+    # Plain calls: these run as is on the service
+    CALLS = ('get_status', 'get_metrics', 'get_progress', 'register_task', 'finish_task', 'delete_messages', 'wake_jobs')
+
+    def handle(self):
+        try:
+            kind, payload = read_frame(self.rfile)
+        except ConnectionError:
+            return
+        request = json.loads(payload)
+        method, args = request['method'], request.get('args', {})
+        service = self.server.service
+        try:
+            if method in self.CALLS:
+                send_json(self.wfile, {'result': getattr(service, method)(**args)})
+            elif method == 'upload_stream':
+                # The raw body follows the request; the service reads exactly `size` bytes
+                service.upload_stream(self.rfile, **args)
+                send_json(self.wfile, {'result': None})
+            elif method == 'open_download':
+                self.stream_download(service, args)
+            elif method == 'stream_progress':
+                for batch in service.stream_progress(**args):
+                    send_json(self.wfile, {'result': batch})
+                    self.wfile.flush()
+                send_frame(self.wfile, b'E')
+            else:
+                send_json(self.wfile, {'error': f"Unknown gateway method: {method}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            try:
+                send_json(self.wfile, {'error': str(e)})
+            except OSError:
+                pass
+
+    def stream_download(self, service, args):
+        size, chunks = service.open_download(**args)
+        try:
+            send_json(self.wfile, {'result': size})
+            for chunk in chunks:
+                send_frame(self.wfile, b'B', chunk)
+            send_frame(self.wfile, b'E')
+        finally:
+            # Cancels the transfer if the worker went away mid-download
+            chunks.close()
+
+
+class GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path) # left over from a previous run
+        self.service = service
+        super().__init__(path, GatewayHandler)
+
+
+class GatewayClient:
+    """Stand-in for TelegramService in web workers, forwarding to the gateway."""
+
+    def __init__(self, path, timeout=300):
+        self.path = path
+        self.timeout = timeout
+        self.jobs = None
+
+    def start(self, flask_app=None):
+        # Staged uploads are queued straight into the shared job table
+        from jobs import UploadJobQueue
+        if flask_app:
+            self.jobs = UploadJobQueue.from_config(flask_app)
+
+    def _open(self, method, args, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout or self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise Exception(f"Telegram gateway unavailable at {self.path}: {e}")
+        rfile, wfile = sock.makefile('rb'), sock.makefile('wb')
+        send_json(wfile, {'method': method, 'args': args})
+        wfile.flush()
+        return sock, rfile, wfile
+
+    def _call(self, method, timeout=None, **args):
+        sock, rfile, wfile = self._open(method, args, timeout)
+        with sock, rfile, wfile:
+            return read_result(rfile)
+
+    def get_status(self):
+        return self._call('get_status', timeout=10)
+
+    def get_metrics(self):
+        return self._call('get_metrics', timeout=10)
+
+    def get_progress(self, task_id):
+        return self._call('get_progress', task_id=task_id)
+
+    # Progress is best effort: an unreachable gateway mustn't fail the upload request
+    def register_task(self, task_id, owner):
+        try:
+            self._call('register_task', timeout=5, task_id=task_id, owner=owner)
+        except Exception:
+            pass
+
+    def finish_task(self, task_id):
+        try:
+            self._call('finish_task', timeout=5, task_id=task_id)
+        except Exception:
+            pass
+
+    def delete_messages(self, msg_ids, chat_id=None):
+        return self._call('delete_messages', msg_ids=[int(mid) for mid in msg_ids if mid], chat_id=chat_id)
+
+    def submit_upload(self, path, db_file_id, task_id=None):
+        job_id = self.jobs.enqueue(db_file_id, path, task_id)
+        try:
+            self._call('wake_jobs', timeout=5)
+        except Exception:
+            pass # the gateway polls the job table anyway
+        return job_id
+
+    def upload_stream(self, stream, size, name, db_file_id, task_id=None, timeout=300):
+        sock, rfile, wfile = self._open('upload_stream', {
+            'size': size,
+            'name': name,
+            'db_file_id': db_file_id,
+            'task_id': task_id,
+            'timeout': timeout
+        }, timeout)
+        with sock, rfile, wfile:
+            remaining = size
+            try:
+                while remaining > 0:
+                    data = stream.read(min(1024 * 1024, remaining))
+                    if not data:
+                        raise Exception(f"Upload body ended {remaining} bytes early")
+                    wfile.write(data)
+                    remaining -= len(data)
+                wfile.flush()
+            except OSError:
+                pass # the gateway stopped reading; its reply says why
+            return read_result(rfile)
+
+    def open_download(self, msg_id, offset=0, length=None, timeout=300, chat_id=None, chunk_map=None, wait=True):
+        sock, rfile, wfile = self._open('open_download', {
+            'msg_id': int(msg_id),
+            'offset': offset,
+            'length': length,
+            'timeout': timeout,
+            'chat_id': chat_id,
+            'chunk_map': chunk_map
+        }, timeout)
+        size = None
+        if wait:
+            try:
+                size = read_result(rfile)
+            except BaseException:
+                sock.close()
+                raise
+
+        def chunks():
+            with sock, rfile, wfile:
+                yield # primed below, so close() always closes the connection
+                if not wait:
+                    read_result(rfile)
+                while True:
+                    kind, payload = read_frame(rfile)
+                    if kind == b'E':
+                        return
+                    if kind == b'J':
+                        raise Exception(json.loads(payload).get('error', "Telegram gateway error"))
+                    yield payload
+
+        stream = chunks()
+        next(stream)
+        return size, stream
+
+    def download_file_to_stream(self, msg_id, output, chat_id=None, chunk_map=None):
+        _, chunks = self.open_download(msg_id, chat_id=chat_id, chunk_map=chunk_map)
+        for chunk in chunks:
+            output.write(chunk)
+
+    def stream_progress(self, owner, timeout=None):
+        # Keep-alives arrive at least every 15s while the stream is open
+        sock, rfile, wfile = self._open('stream_progress', {'owner': owner, 'timeout': timeout}, 60)
+        with sock, rfile, wfile:
+            while True:
+                kind, payload = read_frame(rfile)
+                if kind == b'E':
+                    return
+                message = json.loads(payload)
+                if 'error' in message:
+                    raise Exception(message['error'])
+                yield message['result']
+
+
+def create_app():
+    """A bare Flask app for database access from the gateway process."""
+    from flask import Flask
+    from database import db
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    return app
+
+
+def main():
+    from telegram_service import telegram_service
+    if not Config.TELEGRAM_GATEWAY:
+        raise SystemExit("TELEGRAM_GATEWAY must be set to the socket path to serve on")
+    app = create_app()
+    # Listen first: calls made while Telegram connects wait for it inside the service
+    server = GatewayServer(Config.TELEGRAM_GATEWAY, telegram_service)
+    # gunicorn stops us with SIGTERM; exit through the finally below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    telegram_service.start(app)
+    telegram_service._log(f"Gateway listening on {Config.TELEGRAM_GATEWAY}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(Config.TELEGRAM_GATEWAY):
+            os.remove(Config.TELEGRAM_GATEWAY)
+
+
+if __name__ == '__main__':
+    main()
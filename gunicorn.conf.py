@@ -0,0 +1,58 @@
+"""gunicorn settings: several web workers sharing one Telegram gateway.
+
+The master prepares the database and starts gateway.py before forking the
+workers, and stops the gateway on exit; workers find it through
+TELEGRAM_GATEWAY, which is set here so they inherit it.
+"""
+import os
+import subprocess
+import sys
+import time
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('TELEGRAM_GATEWAY', os.path.join('/tmp', 'telegram-cloud-gateway.sock'))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Threads, so SSE progress streams and long transfers don't tie up a whole worker
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+
+gateway = None
+
+
+def setup_database(server):
+    from database import db, prepare_database
+    from gateway import create_app
+    app = create_app()
+    with app.app_context():
+        backend = prepare_database()
+        db.engine.dispose()
+    server.log.info(f"Database ready; search uses {backend}")
+
+
+def on_starting(server):
+    global gateway
+    setup_database(server)
+    path = os.environ['TELEGRAM_GATEWAY']
+    if os.path.exists(path):
+        os.remove(path)
+    gateway = subprocess.Popen([sys.executable, os.path.join(basedir, 'gateway.py')], cwd=basedir)
+    # Workers can start once the socket is up; Telegram itself may still be connecting
+    deadline = time.time() + 30
+    while not os.path.exists(path) and gateway.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if not os.path.exists(path):
+        server.log.error("Telegram gateway did not start; Telegram features will fail")
+    else:
+        server.log.info(f"Telegram gateway running on {path} (pid {gateway.pid})")
+
+
+def on_exit(server):
+    if gateway and gateway.poll() is None:
+        gateway.terminate()
+        try:
+            gateway.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            gateway.kill()
@@ -0,0 +1,133 @@
+"""Durable queue of staged uploads waiting to go to Telegram.
+
+Jobs are rows in upload_jobs rather than in-memory futures, so an upload
+outlives the worker that accepted it. A job is claimed with a conditional
+UPDATE, keeps its `updated_at` fresh while it runs, and is put back in the
+queue by recover() if that stops for longer than the lease (the worker died).
+Failed attempts are retried with exponential backoff.
+"""
+import random
+from datetime import datetime, timedelta
+
+from config import Config
+from database import db, UploadJob
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+
+
+class UploadJobQueue:
+    def __init__(self, app, max_attempts=5, backoff=5, max_backoff=600, lease=120):
+        self.app = app
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+    @classmethod
+    def from_config(cls, app):
+        return cls(
+            app,
+            max_attempts=Config.UPLOAD_JOB_MAX_ATTEMPTS,
+            backoff=Config.UPLOAD_JOB_BACKOFF,
+            max_backoff=Config.UPLOAD_JOB_MAX_BACKOFF,
+            lease=Config.UPLOAD_JOB_LEASE
+        )
+
+    def _update(self, job_id, **values):
+        with self.app.app_context():
+            values['updated_at'] = datetime.utcnow()
+            UploadJob.query.filter_by(id=job_id).update(values)
+            db.session.commit()
+
+    def enqueue(self, file_id, path, task_id=None):
+        with self.app.app_context():
+            job = UploadJob(file_id=file_id, path=path, task_id=task_id)
+            db.session.add(job)
+            db.session.commit()
+            return job.id
+
+    def recover(self):
+        """Requeues running jobs whose worker stopped reporting. Returns how many."""
+        with self.app.app_context():
+            stale = datetime.utcnow() - timedelta(seconds=self.lease)
+            count = UploadJob.query.filter(
+                UploadJob.state == RUNNING,
+                UploadJob.updated_at < stale
+            ).update({'state': QUEUED, 'next_attempt_at': datetime.utcnow()})
+            db.session.commit()
+            return count
+
+    def claim(self, limit):
+        """Marks up to `limit` due jobs as running and returns them as dicts."""
+        if limit <= 0:
+            return []
+        with self.app.app_context():
+            now = datetime.utcnow()
+            due = UploadJob.query.filter(
+                UploadJob.state == QUEUED,
+                UploadJob.next_attempt_at <= now
+            ).order_by(UploadJob.next_attempt_at, UploadJob.id).limit(limit).all()
+            claimed = []
+            for job in due:
+                # Another worker may have taken it since the SELECT
+                won = UploadJob.query.filter_by(id=job.id, state=QUEUED).update({
+                    'state': RUNNING,
+                    'updated_at': now
+                })
+                db.session.commit()
+                if won:
+                    db.session.refresh(job)
+                    claimed.append(job.to_dict())
+            return claimed
+
+    def seconds_until_due(self):
+        """Seconds until the next queued job is due, or None if there is none."""
+        with self.app.app_context():
+            next_at = db.session.query(db.func.min(UploadJob.next_attempt_at)) \
+                .filter(UploadJob.state == QUEUED).scalar()
+            if next_at is None:
+                return None
+            return max((next_at - datetime.utcnow()).total_seconds(), 0)
+
+    def save_progress(self, job_id, **values):
+        """Records resume state (part_file_id, parts_done, bytes_uploaded) and renews the lease."""
+        self._update(job_id, **values)
+
+    def succeed(self, job_id):
+        with self.app.app_context():
+            UploadJob.query.filter_by(id=job_id).delete()
+            db.session.commit()
+
+    def retry(self, job_id, error, delay=None):
+        """Schedules another attempt, or gives up after max_attempts.
+
+        With `delay` (e.g. a FloodWait) the job waits that long and the
+        attempt isn't counted. Returns the job's new state.
+        """
+        with self.app.app_context():
+            job = UploadJob.query.get(job_id)
+            if job is None:
+                return FAILED
+            attempts = job.attempts
+        if delay is None:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self._update(job_id, state=FAILED, attempts=attempts, last_error=str(error))
+                return FAILED
+            # Jittered so jobs that failed together don't retry together
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff) * random.uniform(0.8, 1.2)
+        self._update(
+            job_id,
+            state=QUEUED,
+            attempts=attempts,
+            last_error=str(error),
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+        )
+        return QUEUED
+
+    def stats(self):
+        with self.app.app_context():
+            rows = db.session.query(UploadJob.state, db.func.count()).group_by(UploadJob.state).all()
+            return {state: count for state, count in rows}
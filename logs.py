@@ -0,0 +1,47 @@
+"""Logging that never blocks the caller.
+
+Records are put on a queue and written to stdout and the log file by a
+listener thread, so the Telegram event loop doesn't wait on disk or a
+slow pipe. The last lines are also kept in memory for /debug_status.
+"""
+import atexit
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+class RecentLines(logging.Handler):
+    """Keeps the last `capacity` formatted records."""
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.lines = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def queued_logger(name, path=None, tail=100):
+    """Returns (logger, recent): a logger writing through a background thread,
+    and the RecentLines handler holding its last `tail` lines."""
+    formatter = logging.Formatter(f'[%(asctime)s] [{name}] %(message)s', '%Y-%m-%d %H:%M:%S')
+    recent = RecentLines(tail)
+    handlers = [logging.StreamHandler(sys.stdout), recent]
+    if path:
+        handlers.append(logging.FileHandler(path, delay=True))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    # Writes out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    return logger, recent
@@ -0,0 +1,146 @@
+"""Counters and timings for the Telegram pipeline, served on /metrics.
+
+A small in-process registry rendered in the Prometheus text format. The
+service records into the metrics defined at the bottom; in multi-worker
+mode they live in the gateway process, and the web worker answering
+/metrics asks the gateway for its samples (see TelegramService.get_metrics).
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, for queue waits, RPCs and DB writes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Bytes per second, for whole transfers
+SPEED_BUCKETS = tuple(2 ** n * 64 * 1024 for n in range(12)) # 64 KiB/s .. 128 MiB/s
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def collect(self):
+        """The families that have samples, as JSON-friendly dicts."""
+        with self.lock:
+            families = [metric.family() for metric in self.metrics]
+        return [family for family in families if family['samples']]
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry or REGISTRY
+        self.values = {}
+        self.registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def family(self):
+        return {'name': self.name, 'type': self.kind, 'help': self.help, 'samples': self._samples()}
+
+    def _samples(self):
+        return [[self.name, dict(zip(self.labels, key)), value] for key, value in self.values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            counts = self.values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the block took, in seconds, failed or not."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        samples = []
+        for key, (buckets, count, total) in self.values.items():
+            labels = dict(zip(self.labels, key))
+            for bound, n in zip(self.buckets, buckets):
+                samples.append([self.name + '_bucket', dict(labels, le=_number(bound)), n])
+            samples.append([self.name + '_bucket', dict(labels, le='+Inf'), count])
+            samples.append([self.name + '_count', labels, count])
+            samples.append([self.name + '_sum', labels, total])
+        return samples
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render(families):
+    """Prometheus text exposition of collect()ed families; same-named ones are merged."""
+    merged = {}
+    for family in families:
+        if family['name'] in merged:
+            merged[family['name']]['samples'] += family['samples']
+        else:
+            merged[family['name']] = dict(family, samples=list(family['samples']))
+    lines = []
+    for family in merged.values():
+        lines.append(f"# HELP {family['name']} {family['help']}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for name, labels, value in family['samples']:
+            label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {_number(value)}" if label_text else f"{name} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot(name, help, values, label=None, kind='gauge'):
+    """A family for numbers kept elsewhere and read at scrape time.
+
+    `values` is a single number, or {label_value: number} with `label`.
+    """
+    if label is None:
+        samples = [[name, {}, values]]
+    else:
+        samples = [[name, {label: key}, value] for key, value in values.items()]
+    return {'name': name, 'type': kind, 'help': help, 'samples': samples}
+
+
+REGISTRY = Registry()
+
+QUEUE_WAIT = Histogram('telegram_queue_wait_seconds', "Time commands waited for a worker slot", ['command'])
+COMMAND_SECONDS = Histogram('telegram_command_seconds', "Time commands took once running", ['command', 'outcome'])
+RPC_SECONDS = Histogram('telegram_rpc_seconds', "Time of single Telegram requests", ['method'])
+FLOOD_WAITS = Counter('telegram_flood_waits_total', "FloodWait errors received", ['method'])
+FLOOD_WAIT_SECONDS = Counter('telegram_flood_wait_seconds_total', "Seconds Telegram asked us to wait", ['method'])
+TRANSFER_BYTES = Counter('telegram_transfer_bytes_total', "Bytes moved by completed transfers", ['direction'])
+TRANSFER_SPEED = Histogram('telegram_transfer_bytes_per_second', "Throughput of whole transfers",
+                           ['direction'], buckets=SPEED_BUCKETS)
+DB_SECONDS = Histogram('telegram_db_update_seconds', "Time of the service's database writes", ['operation'])
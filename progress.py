@@ -0,0 +1,106 @@
+"""Upload progress shared between the Telegram loop and the web workers.
+
+The loop thread reports progress as often as Telethon calls back; browsers
+read it through one Server-Sent Events stream per session, which sends only
+what changed and at most once per `interval`. Finished tasks are dropped
+`ttl` seconds after they settle.
+"""
+import threading
+import time
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Tasks that never settle (e.g. lost with a restarted worker) go after this long
+STALE_AFTER = 3600
+
+
+class ProgressHub:
+    def __init__(self, interval=0.3, ttl=300):
+        self.interval = interval
+        self.ttl = ttl
+        self.tasks = {} # { task_id: {'owner', 'progress', 'state', 'version', 'updated'} }
+        self._version = 0
+        self._last_sweep = 0
+        self._cond = threading.Condition()
+
+    def _set(self, task_id, progress, state, owner=None):
+        with self._cond:
+            task = self.tasks.get(task_id)
+            if task is None:
+                task = self.tasks[task_id] = {'owner': owner, 'progress': None, 'state': None}
+            elif owner is not None:
+                task['owner'] = owner
+            if task['progress'] == progress and task['state'] == state:
+                return
+            self._version += 1
+            task.update(progress=progress, state=state, version=self._version, updated=time.monotonic())
+            self._cond.notify_all()
+            self._sweep()
+
+    def register(self, task_id, owner):
+        """Starts tracking `task_id` for the browser session `owner`."""
+        if task_id:
+            self._set(task_id, 0, PENDING, owner)
+
+    def update(self, task_id, progress):
+        self._set(task_id, progress, PENDING)
+
+    def finish(self, task_id):
+        if task_id:
+            self._set(task_id, 100, DONE)
+
+    def fail(self, task_id):
+        if task_id:
+            self._set(task_id, -1, FAILED)
+
+    def get(self, task_id):
+        task = self.tasks.get(task_id)
+        return task['progress'] if task else 0
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.interval:
+            return
+        self._last_sweep = now
+        for task_id, task in list(self.tasks.items()):
+            age = now - task['updated']
+            if (task['state'] != PENDING and age > self.ttl) or age > STALE_AFTER:
+                del self.tasks[task_id]
+
+    def _changes(self, owner, since):
+        return [
+            {'task_id': task_id, 'progress': task['progress'], 'state': task['state']}
+            for task_id, task in self.tasks.items()
+            if task['owner'] == owner and task['version'] > since
+        ]
+
+    def stream(self, owner, heartbeat=15.0, timeout=None):
+        """Yields lists of changed tasks for `owner`, or None as a keep-alive.
+
+        The first batch is the current state of all the owner's tasks. Ends
+        once the owner has nothing left in flight, or after `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        seen = 0
+        wait = 0 # the first batch goes out right away
+        while True:
+            with self._cond:
+                changed = self._cond.wait_for(lambda: self._version > seen, timeout=wait)
+                self._sweep()
+                events = self._changes(owner, seen)
+                seen = self._version
+                active = any(
+                    task['owner'] == owner and task['state'] == PENDING
+                    for task in self.tasks.values()
+                )
+            if events:
+                yield events
+            elif not changed and wait:
+                yield None
+            if not active or (deadline and time.monotonic() > deadline):
+                return
+            # Coalesce: whatever happens meanwhile goes out in one batch
+            time.sleep(self.interval)
+            wait = heartbeat
@@ -0,0 +1,170 @@
+"""File search by name and metadata, backed by an index in the database.
+
+SQLite: an FTS5 table with the trigram tokenizer over files.name, kept in
+step by triggers. PostgreSQL: a pg_trgm GIN index on lower(name), which
+LIKE '%...%' can use. Either way the index is maintained by the database
+itself, so uploads, renames and bulk deletes need no extra work. Without
+FTS5 or pg_trgm, and for terms under three characters on SQLite, names
+are matched with a LIKE scan.
+
+Every whitespace-separated term must occur somewhere in the name, which
+covers both prefix ("rep" finds report.pdf) and substring queries.
+"""
+from datetime import datetime
+
+from sqlalchemy import column, func, inspect, text
+
+from database import db, File, Folder
+
+FTS5 = 'fts5'
+TRIGRAM = 'pg_trgm'
+LIKE = 'like'
+
+SQLITE_SETUP = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS files_search
+       USING fts5(name, content='files', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+         INSERT INTO files_search(rowid, name) VALUES (new.id, new.name);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+         INSERT INTO files_search(files_search, rowid, name) VALUES ('delete', old.id, old.name);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS files_search_update AFTER UPDATE OF name ON files BEGIN
+         INSERT INTO files_search(files_search, rowid, name) VALUES ('delete', old.id, old.name);
+         INSERT INTO files_search(rowid, name) VALUES (new.id, new.name);
+       END""",
+]
+
+POSTGRES_SETUP = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_files_name_trgm ON files USING gin (lower(name) gin_trgm_ops)",
+]
+
+# Which of the above each engine ended up with, set by install()
+_backends = {}
+
+# An FTS5 match with at least this many hits is left to a scan in sort
+# order instead: it finds a page of such a common term within a few rows,
+# while the index lookup would have to collect and sort every hit first.
+BROAD_MATCH = 2000
+
+
+def install(engine=None):
+    """Creates the search index if missing; returns the backend in use.
+
+    An index created here is filled from the existing rows.
+    """
+    engine = engine or db.engine
+    backend = LIKE
+    try:
+        if engine.dialect.name == 'sqlite':
+            new = not inspect(engine).has_table('files_search')
+            with engine.begin() as conn:
+                for statement in SQLITE_SETUP:
+                    conn.execute(text(statement))
+                if new:
+                    conn.execute(text("INSERT INTO files_search(files_search) VALUES ('rebuild')"))
+            backend = FTS5
+        elif engine.dialect.name == 'postgresql':
+            with engine.begin() as conn:
+                for statement in POSTGRES_SETUP:
+                    conn.execute(text(statement))
+            backend = TRIGRAM
+    except Exception as e:
+        print(f"Search index unavailable, falling back to LIKE scans: {e}")
+    _backends[engine.url] = backend
+    return backend
+
+
+def detect(engine=None):
+    """Like install(), but only looks at what exists; returns the backend in use."""
+    engine = engine or db.engine
+    backend = LIKE
+    if engine.dialect.name == 'sqlite':
+        if inspect(engine).has_table('files_search'):
+            backend = FTS5
+    elif engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            if conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_files_name_trgm'")).first():
+                backend = TRIGRAM
+    _backends[engine.url] = backend
+    return backend
+
+
+def rebuild(engine=None):
+    """Refills the index from the files table (after restoring a dump, say)."""
+    engine = engine or db.engine
+    if install(engine) == FTS5:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO files_search(files_search) VALUES ('rebuild')"))
+    elif engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text("REINDEX INDEX ix_files_name_trgm"))
+
+
+def backend(engine=None):
+    engine = engine or db.engine
+    return _backends.get(engine.url, LIKE)
+
+
+def _like_escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def name_condition(query):
+    """A WHERE clause on File matching names containing every term of `query`."""
+    terms = query.split()
+    conditions = []
+    if backend() == FTS5:
+        # Trigrams need three characters; shorter terms are scanned for below
+        indexed = [term for term in terms if len(term) >= 3]
+        terms = [term for term in terms if len(term) < 3]
+        if indexed:
+            match = ' AND '.join('"%s"' % term.replace('"', '""') for term in indexed)
+            hits = db.session.execute(
+                text("SELECT count(*) FROM (SELECT 1 FROM files_search WHERE files_search MATCH :match LIMIT :limit)"),
+                {'match': match, 'limit': BROAD_MATCH}
+            ).scalar()
+            if hits < BROAD_MATCH:
+                ids = text("SELECT rowid FROM files_search WHERE files_search MATCH :match") \
+                    .bindparams(match=match).columns(column('rowid'))
+                conditions.append(File.id.in_(ids))
+            else:
+                terms += indexed
+    for term in terms:
+        conditions.append(func.lower(File.name).like(f"%{_like_escape(term.lower())}%", escape='\\'))
+    return db.and_(*conditions)
+
+
+def search_files(query=None, folder_id=None, mime_type=None, min_size=None, max_size=None,
+                 created_after=None, created_before=None):
+    """A File query for the matching files, anywhere in the tree unless `folder_id` is given.
+
+    `folder_id` includes its subfolders. `mime_type` is a full type or a
+    prefix such as "image/" or "image". Sizes are in bytes, dates are
+    datetimes or ISO strings; all bounds are inclusive.
+    """
+    files = File.query
+    if query and query.strip():
+        files = files.filter(name_condition(query))
+    if folder_id is not None:
+        files = files.filter(File.folder_id.in_(Folder.subtree_ids(folder_id)))
+    if mime_type:
+        if '/' in mime_type and not mime_type.endswith('/'):
+            files = files.filter(File.mime_type == mime_type)
+        else:
+            prefix = mime_type if mime_type.endswith('/') else mime_type + '/'
+            files = files.filter(File.mime_type.like(_like_escape(prefix) + '%', escape='\\'))
+    if min_size is not None:
+        files = files.filter(File.size >= min_size)
+    if max_size is not None:
+        files = files.filter(File.size <= max_size)
+    if created_after:
+        files = files.filter(File.created_at >= _as_datetime(created_after))
+    if created_before:
+        files = files.filter(File.created_at <= _as_datetime(created_before))
+    return files
+
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
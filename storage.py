@@ -0,0 +1,128 @@
+"""Storage targets: the Telegram chats uploaded files are kept in.
+
+A target is one chat ('me', a channel, a group) on one account. With
+several targets, uploads are spread over them by a placement policy, so
+transfers run on several accounts' connections and rate limits at once.
+Reads and deletes go to the target whose chat_id the File row recorded.
+
+STORAGE_TARGETS lists them as `[account:]entity`, comma separated, e.g.
+"me, -1001234567890, backup:me". The default account uses the configured
+session; any other account NAME reads its session string from
+TELEGRAM_SESSION_STRING_<NAME>.
+"""
+import contextlib
+import itertools
+
+from telethon import utils
+
+DEFAULT_ACCOUNT = 'default'
+
+
+def parse_targets(spec):
+    """Returns [(account, entity)] from a STORAGE_TARGETS string."""
+    targets = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        account, _, entity = item.rpartition(':')
+        entity = entity.strip()
+        # Numeric ids must reach Telethon as ints; usernames and 'me' stay strings
+        if entity.lstrip('-').isdigit():
+            entity = int(entity)
+        targets.append((account.strip() or DEFAULT_ACCOUNT, entity))
+    return targets or [(DEFAULT_ACCOUNT, 'me')]
+
+
+class StorageTarget:
+    def __init__(self, account, client, entity='me'):
+        self.account = account
+        self.client = client
+        self.entity = entity
+        self.chat_id = None # known once resolve() ran
+        # Load, as seen by this process
+        self.in_flight = 0
+        self.bytes_in_flight = 0
+        self.uploads = 0
+        self.bytes_uploaded = 0
+
+    @property
+    def name(self):
+        return f"{self.account}:{self.entity}"
+
+    async def resolve(self):
+        """Looks up the chat id messages sent to this target will carry."""
+        entity = await self.client.get_entity(self.entity)
+        self.chat_id = utils.get_peer_id(entity)
+        return self.chat_id
+
+    @contextlib.contextmanager
+    def track(self, size=0):
+        """Counts a transfer of `size` bytes against this target while it runs."""
+        size = size or 0
+        self.in_flight += 1
+        self.bytes_in_flight += size
+        try:
+            yield self
+        finally:
+            self.in_flight -= 1
+            self.bytes_in_flight -= size
+
+    def stats(self):
+        return {
+            'target': self.name,
+            'chat_id': self.chat_id,
+            'in_flight': self.in_flight,
+            'bytes_in_flight': self.bytes_in_flight,
+            'uploads': self.uploads,
+            'bytes_uploaded': self.bytes_uploaded,
+        }
+
+
+class RoundRobinPolicy:
+    """Each upload goes to the next target in turn."""
+
+    def __init__(self):
+        self._turn = itertools.count()
+
+    def choose(self, targets, size):
+        return targets[next(self._turn) % len(targets)]
+
+
+class LeastLoadedPolicy:
+    """The target with the fewest transfers running, then the fewest bytes stored."""
+
+    def choose(self, targets, size):
+        return min(targets, key=lambda t: (t.in_flight, t.bytes_uploaded))
+
+
+class SizeAwarePolicy:
+    """Large files go where the fewest bytes are in flight; small ones take turns.
+
+    Keeps one account from ending up with several big transfers while
+    another only gets small files.
+    """
+
+    def __init__(self, large_file=20 * 1024 * 1024):
+        self.large_file = large_file
+        self._small = RoundRobinPolicy()
+
+    def choose(self, targets, size):
+        if size is not None and size >= self.large_file:
+            return min(targets, key=lambda t: (t.bytes_in_flight, t.in_flight))
+        return self._small.choose(targets, size)
+
+
+POLICIES = {
+    'round_robin': RoundRobinPolicy,
+    'least_loaded': LeastLoadedPolicy,
+    'size_aware': SizeAwarePolicy,
+}
+
+
+def make_policy(name, large_file=None):
+    if name not in POLICIES:
+        raise ValueError(f"Unknown storage policy {name!r}; expected one of {', '.join(POLICIES)}")
+    if name == 'size_aware' and large_file:
+        return SizeAwarePolicy(large_file)
+    return POLICIES[name]()
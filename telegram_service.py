@@ -1,12 +1,58 @@
 import os
 import asyncio
+import collections
 import threading
-import queue
-import sys
+import concurrent.futures
+import functools
+import hashlib
+import uuid
 import time
-from telethon import TelegramClient
+from contextlib import asynccontextmanager
+from telethon import TelegramClient, errors
 from telethon.sessions import StringSession
 from config import Config
+from jobs import FAILED, UploadJobQueue
+from logs import queued_logger
+import metrics
+from progress import ProgressHub
+from storage import DEFAULT_ACCOUNT, StorageTarget, make_policy, parse_targets
+import thumbnails
+from transfer import MAX_PART_SIZE, ParallelDownloader, ParallelUploader, SenderPool, file_parts, media_location, new_file_id
+
+class Slot:
+    """A running command's hold on one of its type's worker slots.
+
+    The command can lend it out while it waits on something other than
+    Telegram; release() is a no-op once it isn't held.
+    """
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.held = False
+        self._returned = asyncio.Event()
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        self.held = True
+        self._returned.set()
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self._returned.clear()
+            self.semaphore.release()
+
+    async def wait_held(self):
+        """Returns once the slot is held, so not while it is lent out."""
+        await self._returned.wait()
+
+    @asynccontextmanager
+    async def lent(self):
+        self.release()
+        try:
+            yield
+        finally:
+            await self.acquire()
 
 class TelegramService:
     def __init__(self):
@@ -21,51 +67,138 @@ class TelegramService:
         self.ready_event = threading.Event()
         self.app = None # To be set by app.py
         
-        # Communication queues
-        self.request_queue = queue.Queue()
-        self.result_queues = {}
+        self._connected = None
+        self.authorized = False
         
-        # Progress tracking: { task_id: percentage }
-        self.progress_data = {}
+        # Upload progress by task_id, streamed to browsers by app.py
+        self.progress = ProgressHub(Config.PROGRESS_INTERVAL, Config.PROGRESS_TTL)
+
+        # Worker pool: max concurrent commands per type, plus live counters
+        self.limits = {
+            'upload': Config.UPLOAD_CONCURRENCY,
+            'download': Config.DOWNLOAD_CONCURRENCY,
+            'delete': Config.DELETE_CONCURRENCY,
+        }
+        self.queued = {cmd: 0 for cmd in self.limits}
+        self.in_flight = {cmd: 0 for cmd in self.limits}
+        self._slots = {}
+
+        # Chats files go to, and how uploads pick one (see storage.py)
+        self.targets = []
+        # The default account's Saved Messages, where rows from before
+        # sharding live; readable even when it isn't an upload target
+        self.home = None
+        self.placement = make_policy(Config.STORAGE_POLICY, Config.STORAGE_LARGE_FILE)
+
+        # Extra connections for parallel transfers, opened on first use
+        self.upload_pools = {} # { account: SenderPool }
+        self.download_pools = {} # { (account, dc_id): SenderPool }
+
+        # Durable queue of staged uploads (needs the Flask app for the DB)
+        self.jobs = None
+        self._jobs_wakeup = None
+        self._running_jobs = set()
+
+        # Written by a background thread, so logging never stalls the event loop
+        self.logger, self.recent_logs = queued_logger('TelegramService', 'telegram_service.log')
 
     def _progress_callback(self, current, total, task_id):
         if total > 0:
             percent = int((current / total) * 100)
-            self.progress_data[task_id] = percent
+            self.progress.update(task_id, percent)
+
+    def finish_task(self, task_id):
+        # For uploads settled without a transfer (e.g. deduplicated)
+        self.progress.finish(task_id)
 
     def get_progress(self, task_id):
-        if task_id not in self.progress_data:
-            # self._log(f"Warning: task_id {task_id} not found")
-            return 0
-        return self.progress_data.get(task_id, 0)
+        return self.progress.get(task_id)
+
+    def register_task(self, task_id, owner):
+        self.progress.register(task_id, owner)
+
+    def stream_progress(self, owner, timeout=None):
+        return self.progress.stream(owner, timeout=timeout)
+
+    def get_stats(self):
+        return {
+            cmd: {
+                'limit': limit,
+                'queued': self.queued[cmd],
+                'in_flight': self.in_flight[cmd],
+            }
+            for cmd, limit in self.limits.items()
+        }
+
+    def get_status(self):
+        return {
+            'ready': self.ready_event.is_set(),
+            'thread_alive': self.thread.is_alive() if self.thread else False,
+            'worker_pool': self.get_stats(),
+            'upload_jobs': self.jobs.stats() if self.jobs else {},
+            'storage_policy': type(self.placement).__name__,
+            'storage_targets': [target.stats() for target in self.targets],
+            'log_tail': list(self.recent_logs.lines)[-20:],
+        }
+
+    def get_metrics(self):
+        """metrics.collect()-style families: the recorded ones plus the current pool and job numbers."""
+        families = metrics.REGISTRY.collect()
+        families.append(metrics.snapshot('telegram_commands_queued', "Commands waiting for a worker slot", self.queued, 'command'))
+        families.append(metrics.snapshot('telegram_commands_in_flight', "Commands running", self.in_flight, 'command'))
+        families.append(metrics.snapshot('telegram_command_limit', "Worker slots per command", self.limits, 'command'))
+        if self.jobs:
+            families.append(metrics.snapshot('telegram_upload_jobs', "Upload jobs by state", self.jobs.stats(), 'state'))
+        families.append(metrics.snapshot('telegram_ready', "Whether the client is connected and authorized",
+                                       int(self.ready_event.is_set() and self.authorized)))
+        return families
 
     def _log(self, msg):
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        log_msg = f"[{timestamp}] [TelegramService] {msg}"
-        print(log_msg)
-        sys.stdout.flush()
-        # Also log to a file for persistence on PythonAnywhere
-        try:
-            with open("telegram_service.log", "a") as f:
-                f.write(log_msg + "\n")
-        except:
-            pass
+        # Also to telegram_service.log, for persistence on PythonAnywhere
+        self.logger.info(msg)
+
+    def _record_transfer(self, direction, size, started):
+        elapsed = time.perf_counter() - started
+        metrics.TRANSFER_BYTES.inc(size, direction=direction)
+        if size and elapsed > 0:
+            metrics.TRANSFER_SPEED.observe(size / elapsed, direction=direction)
+            self._log(f"{direction.capitalize()} of {size} bytes at {size / elapsed / 1024 / 1024:.2f} MB/s")
+
+    def start(self, flask_app=None, client=None, targets=None):
+        """Starts the background thread with its own asyncio loop.
 
-    def start(self, flask_app=None):
-        """Starts the background thread with its own asyncio loop."""
+        `client` lets callers (benchmarks, tools) inject an already built
+        client instead of connecting with the configured credentials;
+        `targets` likewise injects StorageTargets built on such clients.
+        Given only `targets`, the first one's client is the default account.
+        """
+        if targets:
+            client = client or targets[0].client
+        elif client is not None:
+            targets = [StorageTarget(DEFAULT_ACCOUNT, client, 'me')]
         self.app = flask_app
         if self.thread and self.thread.is_alive():
             return
+        if flask_app:
+            self.jobs = UploadJobQueue.from_config(flask_app)
 
-        if not self.api_id or not self.api_hash:
+        if client is None and (not self.api_id or not self.api_hash):
             self._log("CRITICAL ERROR: API_ID or API_HASH missing from environment variables!")
             self.ready_event.set() # Set it so the app doesn't show "sleeping" but can show specific errors
             return
 
+        # The loop exists before the thread starts so requests can be scheduled
+        # on it right away; they wait on `_connected` until the client is up.
+        self.loop = asyncio.new_event_loop()
+        self._connected = asyncio.Event()
+        self._slots = {cmd: asyncio.Semaphore(limit) for cmd, limit in self.limits.items()}
+        self._jobs_wakeup = asyncio.Event()
+        self.client = client
+        self.targets = targets or []
+
         def run_loop():
             try:
                 self._log("Starting background thread...")
-                self.loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(self.loop)
                 
                 # Use a specific session folder on PythonAnywhere
@@ -88,109 +221,64 @@ class TelegramService:
                     except ImportError:
                         self._log("PySocks NOT INSTALLED! Proxy will not work.")
                 
-                from telethon import connection
-                self.client = TelegramClient(
-                    session, 
-                    self.api_id, 
-                    self.api_hash, 
-                    loop=self.loop, 
-                    proxy=proxy,
-                    connection=connection.ConnectionTcpAbridged
-                )
+                def make_client(session):
+                    from telethon import connection
+                    return TelegramClient(
+                        session, 
+                        self.api_id, 
+                        self.api_hash, 
+                        loop=self.loop, 
+                        proxy=proxy,
+                        connection=connection.ConnectionTcpAbridged
+                    )
+
+                if self.client is None:
+                    self.client = make_client(session)
+                    # Further accounts only come from their own session strings
+                    clients = {DEFAULT_ACCOUNT: self.client}
+                    for account, entity in parse_targets(Config.STORAGE_TARGETS):
+                        if account not in clients:
+                            session_string = os.environ.get(f"TELEGRAM_SESSION_STRING_{account.upper()}")
+                            if not session_string:
+                                self._log(f"No TELEGRAM_SESSION_STRING_{account.upper()}; skipping storage target {account}:{entity}")
+                                continue
+                            clients[account] = make_client(StringSession(session_string))
+                        self.targets.append(StorageTarget(account, clients[account], entity))
+                    save_session = True
+                else:
+                    save_session = False
                 
-                async def worker():
+                async def connect():
                     try:
                         self._log("Connecting to Telegram (Abridged)...")
                         # Try to connect with a longer timeout
                         await asyncio.wait_for(self.client.connect(), timeout=30)
                         
-                        authorized = await self.client.is_user_authorized()
-                        if not authorized:
+                        self.authorized = await self.client.is_user_authorized()
+                        if not self.authorized:
                             self._log("!!! AUTH ERROR: Session String might be invalid or expired.")
                             self._log("Please generate a NEW ONE using run_auth.py locally.")
-                        else:
-                            self._log("Client connected and authorized successfully.")
-                        
-                        self.ready_event.set()
-                        if not authorized: return
-                        
-                        session_str = self.client.session.save()
-                        with open(os.path.join(basedir, "SESSION_STRING_FOR_RENDER.txt"), "w") as f:
-                            f.write(session_str)
-                        
-                        self._log("Session string saved.")
-                        self.ready_event.set()
+                            return
+                        self._log("Client connected and authorized successfully.")
+                        await self._connect_targets()
                         
-                        while True:
-                            try:
-                                try:
-                                    req = self.request_queue.get_nowait()
-                                except queue.Empty:
-                                    await asyncio.sleep(0.1)
-                                    continue
-                                    
-                                thread_id, cmd, args = req
-                                self._log(f"Processing command: {cmd}")
-                                
-                                try:
-                                    if cmd == 'upload':
-                                        task_id = args.get('task_id', thread_id)
-                                        db_file_id = args.get('db_file_id')
-                                        self.progress_data[task_id] = 0
-                                        
-                                        msg = await self.client.send_file(
-                                            'me', 
-                                            args['path'],
-                                            progress_callback=lambda c, t: self._progress_callback(c, t, task_id)
-                                        )
-                                        
-                                        self.progress_data[task_id] = 100
-                                        self._log(f"Upload done for task {task_id}. Msg ID: {msg.id}")
-        
-                                        # Update Database
-                                        if self.app and db_file_id:
-                                            from database import db, File
-                                            with self.app.app_context():
-                                                file_record = File.query.get(db_file_id)
-                                                if file_record:
-                                                    file_record.telegram_id = msg.id
-                                                    file_record.chat_id = msg.chat_id
-                                                    db.session.commit()
-                                                    self._log(f"Database updated for file {db_file_id}")
-        
-                                        if os.path.exists(args['path']):
-                                            os.remove(args['path'])
-                                        
-                                        if thread_id in self.result_queues:
-                                            self.result_queues[thread_id].put(('ok', {'id': msg.id}))
-        
-                                    elif cmd == 'download':
-                                        message = await self.client.get_messages('me', ids=args['msg_id'])
-                                        if message:
-                                            await self.client.download_media(message, args['output'])
-                                            self.result_queues[thread_id].put(('ok', None))
-                                        else:
-                                            self.result_queues[thread_id].put(('error', "Message not found"))
-        
-                                    elif cmd == 'delete':
-                                        await self.client.delete_messages('me', args['msg_ids'])
-                                        self.result_queues[thread_id].put(('ok', None))
-                                        
-                                except Exception as e:
-                                    self._log(f"Error in command {cmd}: {e}")
-                                    if thread_id in self.result_queues:
-                                        self.result_queues[thread_id].put(('error', str(e)))
-                                    if cmd == 'upload':
-                                        self.progress_data[args.get('task_id', thread_id)] = -1
-                                    
-                            except Exception as e:
-                                self._log(f"Worker loop error: {e}")
-                                await asyncio.sleep(1)
+                        if save_session:
+                            session_str = self.client.session.save()
+                            with open(os.path.join(basedir, "SESSION_STRING_FOR_RENDER.txt"), "w") as f:
+                                f.write(session_str)
+                            self._log("Session string saved.")
                     except Exception as e:
                         self._log(f"Worker startup error: {e}")
-                        self.ready_event.set() 
+                    finally:
+                        self._connected.set()
+                        self.ready_event.set()
 
-                self.loop.run_until_complete(worker())
+                self.loop.run_until_complete(connect())
+                if self.jobs and self.authorized:
+                    # Picks up whatever earlier runs left queued or half done
+                    self.loop.create_task(self._schedule_jobs())
+                # Commands arrive through run_coroutine_threadsafe; no polling needed.
+                self.loop.run_forever()
             except Exception as e:
                 self._log(f"Background thread crash: {e}")
                 self.ready_event.set()
@@ -200,43 +288,893 @@ class TelegramService:
         # Do NOT wait here; let the web server finish starting up.
         # We will wait inside _send_request only when a real request comes in.
 
-    def _send_request(self, cmd, args):
+    async def _connect_targets(self):
+        """Connects the other accounts and resolves every target's chat id.
+
+        Targets that can't be reached are dropped; the default account's
+        'me' stays as the fallback so there is always somewhere to upload.
+        It is resolved as `home` either way, for _target_for.
+        """
+        ready = []
+        for target in self.targets:
+            try:
+                if target.client is not self.client:
+                    if not target.client.is_connected():
+                        await asyncio.wait_for(target.client.connect(), timeout=30)
+                    if not await target.client.is_user_authorized():
+                        raise Exception("session is not authorized")
+                await target.resolve()
+                ready.append(target)
+                self._log(f"Storage target {target.name} -> chat {target.chat_id}")
+            except Exception as e:
+                self._log(f"Storage target {target.name} unavailable: {e}")
+        home = next((target for target in ready if target.account == DEFAULT_ACCOUNT and target.entity == 'me'), None)
+        if home is None:
+            home = StorageTarget(DEFAULT_ACCOUNT, self.client, 'me')
+            try:
+                await home.resolve()
+            except Exception as e:
+                self._log(f"Saved Messages of the default account unavailable: {e}")
+                home = None
+        self.home = home
+        if not ready:
+            if home is None:
+                raise Exception("No storage target is reachable")
+            ready.append(home)
+        self.targets = ready
+
+    def _target_for(self, chat_id):
+        """The target to read and delete messages of `chat_id` through.
+
+        That is the upload target with that chat id or, whether or not it
+        is one, the default account's Saved Messages. Rows from before
+        sharding have no chat id and were all stored there.
+        """
+        home = self.home
+        if not chat_id or (home and home.chat_id == chat_id):
+            if home is None:
+                raise Exception("The default account's Saved Messages are unavailable")
+            return home
+        for target in self.targets:
+            if target.chat_id == chat_id:
+                return target
+        raise Exception(f"No storage target is configured for chat {chat_id}")
+
+    async def _run_command(self, request_id, cmd, args):
+        self.queued[cmd] += 1
+        queued_at = time.perf_counter()
+        slot = args['slot'] = Slot(self._slots[cmd])
+        try:
+            await self._connected.wait()
+            if not self.authorized:
+                raise Exception("Telegram client is not connected or not authorized.")
+            # Per-command slots: a long upload never holds up downloads or deletes.
+            await slot.acquire()
+        finally:
+            self.queued[cmd] -= 1
+
+        started = time.perf_counter()
+        metrics.QUEUE_WAIT.observe(started - queued_at, command=cmd)
+        outcome = 'error'
+        self.in_flight[cmd] += 1
+        self._log(f"[{request_id}] Processing command: {cmd} (waited {started - queued_at:.3f}s)")
+        try:
+            result = await self._handlers[cmd](self, request_id, args)
+            outcome = 'ok'
+            return result
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            self._log(f"[{request_id}] Command {cmd} cancelled")
+            if cmd == 'upload' and 'job' not in args:
+                self.progress.fail(args.get('task_id') or request_id)
+            raise
+        except Exception as e:
+            self._log(f"[{request_id}] Error in command {cmd}: {e}")
+            # Jobs may be retried; _run_job reports them failed once it gives up
+            if cmd == 'upload' and 'job' not in args:
+                self.progress.fail(args.get('task_id') or request_id)
+            raise
+        finally:
+            metrics.COMMAND_SECONDS.observe(time.perf_counter() - started, command=cmd, outcome=outcome)
+            self.in_flight[cmd] -= 1
+            slot.release()
+
+    async def _handle_upload(self, request_id, args):
+        task_id = args.get('task_id') or request_id
+        db_file_id = args.get('db_file_id')
+        self.progress.update(task_id, 0)
+
+        progress = lambda c, t: self._progress_callback(c, t, task_id)
+        started = time.perf_counter()
+        path = args.get('path')
+        size = args['size'] if path is None else os.path.getsize(path)
+        chunk_count = None
+        original = None
+        msg = None
+        if size > Config.STORAGE_CHUNK_SIZE:
+            msg_id, chat_id, chunk_count = await self._upload_chunks(args, size, progress)
+            sha256 = args.get('sha256')
+        else:
+            target = self._choose_target(args.get('job'), size)
+            with target.track(size):
+                if path is None:
+                    # Streamed upload: parts arrive from the web thread as they are read
+                    senders = await self._get_upload_pool(target).get()
+                    uploader = ParallelUploader(senders, retries=Config.UPLOAD_PART_RETRIES, log=self._log)
+                    file = await uploader.upload(queued_parts(args['parts']), size, args['name'], progress_callback=progress)
+                elif Config.UPLOAD_WORKERS > 1 and size >= Config.PARALLEL_UPLOAD_THRESHOLD:
+                    # Push the parts ourselves over several connections, then send the
+                    # already uploaded file as a message.
+                    senders = await self._get_upload_pool(target).get()
+                    uploader = ParallelUploader(senders, retries=Config.UPLOAD_PART_RETRIES, log=self._log)
+                    resume = await self._resume_point(args['job'], target, uploader.part_size) if 'job' in args else {}
+                    file = await uploader.upload_file(path, progress_callback=progress, **resume)
+                else:
+                    file = path
+
+                # A streamed upload is only hashed once all of it went by; if the
+                # content is already stored, reuse that message and drop the parts.
+                sha256 = args.get('sha256')
+                original = await self._off_loop(self._find_original, sha256, db_file_id) if sha256 else None
+                if original:
+                    msg_id, chat_id, _ = original
+                    self._log(f"Upload for task {task_id} duplicates message {msg_id}; not sending")
+                else:
+                    try:
+                        with metrics.RPC_SECONDS.time(method='send_file'):
+                            msg = await target.client.send_file(
+                                target.entity,
+                                file,
+                                progress_callback=progress
+                            )
+                    except (errors.FilePartMissingError, errors.FilePartsInvalidError):
+                        # Telegram dropped the saved parts (they expire); the next
+                        # attempt has to start over from the first one
+                        if 'job' in args:
+                            await self._off_loop(self.jobs.save_progress, args['job']['id'],
+                                                 part_file_id=None, parts_done=0, bytes_uploaded=0)
+                        raise
+                    msg_id, chat_id = msg.id, msg.chat_id
+                    target.uploads += 1
+                    target.bytes_uploaded += size
+
+        self._log(f"Upload done for task {task_id}. Msg ID: {msg_id} in chat {chat_id}")
+        if not original:
+            self._record_transfer('upload', size, started)
+
+        # Update Database
+        if self.app and db_file_id:
+            await self._off_loop(self._record_upload, db_file_id, msg_id, chat_id, chunk_count, original, sha256)
+
+            if Config.THUMBNAIL_SIZE:
+                try:
+                    await self._store_thumbnail(db_file_id, path, msg)
+                except Exception as e:
+                    # Not worth failing the upload over; the tile keeps its icon
+                    self._log(f"No thumbnail for file {db_file_id}: {e}")
+
+        # Only now, so a browser reloading on completion sees the final row
+        self.progress.finish(task_id)
+
+        if path and os.path.exists(path):
+            os.remove(path)
+
+        return {'id': msg_id}
+
+    def _record_upload(self, db_file_id, msg_id, chat_id, chunk_count, original, sha256):
+        from database import db, File, FolderStats
+        with self.app.app_context(), metrics.DB_SECONDS.time(operation='upload_done'):
+            file_record = File.query.get(db_file_id)
+            if file_record:
+                if not file_record.telegram_id:
+                    FolderStats.adjust({file_record.folder_id: (1, file_record.size or 0)})
+                file_record.telegram_id = msg_id
+                file_record.chat_id = chat_id
+                file_record.chunk_count = chunk_count
+                if original:
+                    # Compressed or not, like the message it now shares
+                    file_record.codec = original[2]
+                if sha256:
+                    file_record.sha256 = sha256
+                db.session.commit()
+                self._log(f"Database updated for file {db_file_id}")
+
+    async def _upload_chunks(self, args, size, progress):
+        """Stores a file over STORAGE_CHUNK_SIZE as one message per chunk.
+
+        Every chunk goes to the target the placement policy picks for it and
+        gets its FileChunk row as soon as it is sent, so a retried job only
+        sends the chunks still missing. Returns chunk 0's (msg_id, chat_id)
+        and the number of chunks.
+        """
+        db_file_id = args.get('db_file_id')
+        if not (self.app and db_file_id):
+            raise Exception("Files over STORAGE_CHUNK_SIZE need a database row to record their chunks in")
+        path = args.get('path')
+        name = args['name'] if path is None else os.path.basename(path)
+        chunk_size = Config.STORAGE_CHUNK_SIZE
+        parts_per_chunk = chunk_size // MAX_PART_SIZE
+        count = (size + chunk_size - 1) // chunk_size
+        streamed = queued_parts(args['parts']) if path is None else None
+
+        stored = await self._off_loop(self._stored_chunks, db_file_id)
+        if stored:
+            self._log(f"Resuming chunked upload of file {db_file_id}: {len(stored)} of {count} chunks stored")
+
+        for index in range(count):
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            if streamed:
+                parts = take(streamed, parts_per_chunk)
+            elif index in stored:
+                continue
+            else:
+                parts = file_parts(path, MAX_PART_SIZE, first_part=index * parts_per_chunk, count=parts_per_chunk)
+
+            digest = hashlib.sha256()
+            target = self.placement.choose(self.targets, length)
+            with target.track(length):
+                senders = await self._get_upload_pool(target).get()
+                uploader = ParallelUploader(senders, retries=Config.UPLOAD_PART_RETRIES, log=self._log)
+                file = await uploader.upload(
+                    hashed(parts, digest), length, f"{name}.{index:03d}",
+                    progress_callback=lambda current, total, offset=offset: progress(offset + current, size)
+                )
+                with metrics.RPC_SECONDS.time(method='send_file'):
+                    msg = await target.client.send_file(target.entity, file)
+                target.uploads += 1
+                target.bytes_uploaded += length
+
+            # Committed one by one rather than at the end: a retry resumes
+            # from the chunks recorded here
+            await self._off_loop(self._record_chunk, db_file_id, index, msg, length, digest.hexdigest())
+            stored[index] = (msg.id, msg.chat_id)
+            self._log(f"Chunk {index + 1}/{count} of file {db_file_id} stored as msg {msg.id} in chat {msg.chat_id}")
+
+        return stored[0] + (count,)
+
+    def _stored_chunks(self, db_file_id):
+        from database import FileChunk
+        with self.app.app_context():
+            return {chunk.index: (chunk.telegram_id, chunk.chat_id) for chunk in FileChunk.query.filter_by(file_id=db_file_id)}
+
+    def _record_chunk(self, db_file_id, index, msg, length, sha256):
+        from database import db, FileChunk
+        with self.app.app_context(), metrics.DB_SECONDS.time(operation='chunk'):
+            db.session.add(FileChunk(
+                file_id=db_file_id,
+                index=index,
+                telegram_id=msg.id,
+                chat_id=msg.chat_id,
+                size=length,
+                sha256=sha256
+            ))
+            db.session.commit()
+
+    def _choose_target(self, job, size):
+        # A job resumes on the account its saved parts went to, if that is still around
+        if job and job.get('part_file_id') is not None:
+            try:
+                return self._target_for(job.get('chat_id'))
+            except Exception:
+                pass
+        return self.placement.choose(self.targets, size)
+
+    async def _resume_point(self, job, target, part_size):
+        """ParallelUploader arguments continuing `job` after its last acknowledged part.
+
+        Parts finish out of order, so only the unbroken run from part 0 is
+        recorded; at most a few parts past it get sent twice on resume.
+        Saved parts belong to one account, so a job moved to another target
+        starts over.
+        """
+        job_id = job['id']
+        file_id = job['part_file_id']
+        if file_id is not None:
+            try:
+                same_account = self._target_for(job.get('chat_id')) is target
+            except Exception:
+                same_account = False
+            if not same_account:
+                file_id = None
+        first_part = job['parts_done'] if file_id is not None else 0
+        if file_id is None:
+            file_id = new_file_id()
+            await self._off_loop(self.jobs.save_progress, job_id, part_file_id=file_id, chat_id=target.chat_id,
+                                 parts_done=0, bytes_uploaded=0)
+        elif first_part:
+            self._log(f"Resuming upload job {job_id} at part {first_part}")
+
+        acked = set()
+        done = first_part
+        saved_at = time.monotonic()
+        saving = None
+
+        def on_part(index):
+            nonlocal done, saved_at, saving
+            acked.add(index)
+            while done in acked:
+                acked.remove(done)
+                done += 1
+            # One save at a time, so an older count never lands after a newer one
+            if time.monotonic() - saved_at >= Config.UPLOAD_JOB_SAVE_INTERVAL and (saving is None or saving.done()):
+                saved_at = time.monotonic()
+                saving = self._off_loop(self.jobs.save_progress, job_id, parts_done=done, bytes_uploaded=done * part_size)
+                saving.add_done_callback(saved)
+
+        def saved(future):
+            if future.exception():
+                self._log(f"Could not save the progress of upload job {job_id}: {future.exception()}")
+
+        return {'file_id': file_id, 'first_part': first_part, 'on_part': on_part}
+
+    async def _schedule_jobs(self):
+        """Runs due upload jobs, at most UPLOAD_CONCURRENCY of them at a time."""
+        while True:
+            self._jobs_wakeup.clear()
+            try:
+                recovered = await self._off_loop(self.jobs.recover)
+                if recovered:
+                    self._log(f"Requeued {recovered} upload jobs left running by a stopped worker")
+                for job in await self._off_loop(self.jobs.claim, self.limits['upload'] - len(self._running_jobs)):
+                    self._running_jobs.add(job['id'])
+                    self.loop.create_task(self._run_job(job))
+                # When full, a finishing job sets the wakeup
+                full = len(self._running_jobs) >= self.limits['upload']
+                wait = None if full else await self._off_loop(self.jobs.seconds_until_due)
+            except Exception as e:
+                self._log(f"Upload job scheduler error: {e}")
+                wait = None
+            # Also wake up now and then to requeue jobs of workers that died
+            wait = Config.UPLOAD_JOB_LEASE / 2 if wait is None else min(wait, Config.UPLOAD_JOB_LEASE / 2)
+            try:
+                await asyncio.wait_for(self._jobs_wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job):
+        job_id = job['id']
+        args = {
+            'path': job['path'],
+            'task_id': job['task_id'],
+            'db_file_id': job['file_id'],
+            'job': job
+        }
+        try:
+            # Keeps the lease while send_file runs without part callbacks
+            heartbeat = self.loop.create_task(self._renew_lease(job_id))
+            try:
+                await self._run_command(f"job-{job_id}", 'upload', args)
+            finally:
+                heartbeat.cancel()
+            await self._off_loop(self.jobs.succeed, job_id)
+        except errors.FloodWaitError as e:
+            metrics.FLOOD_WAITS.inc(method='send_file')
+            metrics.FLOOD_WAIT_SECONDS.inc(e.seconds, method='send_file')
+            await self._off_loop(self.jobs.retry, job_id, e, delay=e.seconds)
+        except Exception as e:
+            if await self._off_loop(self.jobs.retry, job_id, e) == FAILED:
+                self._log(f"Upload job {job_id} failed for good: {e}")
+                await self._abandon_upload(job)
+            else:
+                self._log(f"Upload job {job_id} will be retried: {e}")
+        finally:
+            self._running_jobs.discard(job_id)
+            self._jobs_wakeup.set()
+
+    async def _renew_lease(self, job_id):
+        while True:
+            await asyncio.sleep(Config.UPLOAD_JOB_LEASE / 4)
+            await self._off_loop(self.jobs.save_progress, job_id)
+
+    def _off_loop(self, func, *args, **kwargs):
+        """Runs a blocking call, like the upload job table's commits, on the default executor.
+
+        Those wait on the database (SQLite's write lock, a remote server);
+        the loop meanwhile keeps every transfer going. Returns an awaitable.
+        """
+        return self.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def _abandon_upload(self, job):
+        # Nothing will ever fill in the placeholder row, so drop it with its
+        # staged copy and whatever chunks of it were already sent
+        self.progress.fail(job['task_id'])
+        await self._drop_placeholder(job['file_id'], job_id=job['id'])
+        if os.path.exists(job['path']):
+            os.remove(job['path'])
+
+    async def _drop_placeholder(self, db_file_id, job_id=None):
+        """Deletes the row of an upload that won't finish, with the chunks of it sent so far.
+
+        The row stays if something filled it in meanwhile. `job_id`'s
+        UploadJob row goes in the same commit.
+        """
+        by_chat = await self._off_loop(self._delete_placeholder, db_file_id, job_id)
+        for chat_id, msg_ids in by_chat.items():
+            try:
+                target = self._target_for(chat_id)
+                await target.client.delete_messages(target.entity, msg_ids)
+            except Exception as e:
+                self._log(f"Could not delete chunks of abandoned upload of file {db_file_id}: {e}")
+
+    def _delete_placeholder(self, db_file_id, job_id):
+        # Returns the chunk messages to delete, by chat
+        from database import db, File, FileChunk, UploadJob
+        by_chat = {}
+        with self.app.app_context():
+            if job_id is not None:
+                UploadJob.query.filter_by(id=job_id).delete()
+            if File.query.filter_by(id=db_file_id, telegram_id=0).count():
+                for chunk in FileChunk.query.filter_by(file_id=db_file_id):
+                    by_chat.setdefault(chunk.chat_id, []).append(chunk.telegram_id)
+                FileChunk.query.filter_by(file_id=db_file_id).delete()
+                File.query.filter_by(id=db_file_id).delete()
+            db.session.commit()
+        return by_chat
+
+    def _streamed_upload_done(self, future, db_file_id):
+        # The web request answered once the body was handed over, so
+        # nobody else is left to clean up after a failed send
+        if future.cancelled() or future.exception() is not None:
+            asyncio.run_coroutine_threadsafe(self._drop_placeholder(db_file_id), self.loop)
+
+    async def _store_thumbnail(self, db_file_id, path, msg):
+        """Saves a Thumbnail for a just uploaded file, from the first source that has one.
+
+        Those are: another file stored in the same message (a deduplicated
+        upload), the staged file if it is an image, and the thumbnail
+        Telegram made for the sent message.
+        """
+        is_image = await self._off_loop(self._share_thumbnail, db_file_id)
+        if is_image is None:
+            return
+
+        made = None
+        if path and is_image:
+            # Decoding a big photo takes a while; keep the loop serving transfers meanwhile
+            made = await self._off_loop(thumbnails.from_image, path, Config.THUMBNAIL_SIZE, Config.THUMBNAIL_QUALITY)
+            source = 'image'
+        if made is None and msg is not None:
+            thumb = thumbnails.pick(thumbnails.telegram_thumbs(msg), Config.THUMBNAIL_SIZE)
+            if thumb:
+                made = await msg.download_media(bytes, thumb=thumb), thumb.w, thumb.h
+                source = 'telegram'
+        if made is None:
+            return
+
+        if await self._off_loop(self._save_thumbnail, db_file_id, made, source):
+            data, width, height = made
+            self._log(f"Stored a {width}x{height} thumbnail ({len(data)} bytes) for file {db_file_id}")
+
+    def _share_thumbnail(self, db_file_id):
+        """Gives the file the thumbnail of another file in the same message, if there is one.
+
+        Returns None when the file needs no thumbnail (anymore), otherwise
+        whether it is an image one can be made from.
+        """
+        from database import db, File, Thumbnail
+        with self.app.app_context():
+            file_record = db.session.get(File, db_file_id)
+            if file_record is None or file_record.has_thumbnail:
+                return None
+            shared = Thumbnail.query.join(File, File.id == Thumbnail.file_id).filter(
+                File.telegram_id == file_record.telegram_id,
+                File.chat_id == file_record.chat_id,
+                File.id != db_file_id
+            ).first()
+            if shared:
+                file_record.thumbnail = shared.copy()
+                file_record.has_thumbnail = True
+                db.session.commit()
+                return None
+            return (file_record.mime_type or '').startswith('image/') and not file_record.codec
+
+    def _save_thumbnail(self, db_file_id, made, source):
+        from database import db, File, Thumbnail
+        with self.app.app_context(), metrics.DB_SECONDS.time(operation='thumbnail'):
+            file_record = db.session.get(File, db_file_id)
+            if file_record is None:
+                return False # Deleted meanwhile
+            data, width, height = made
+            file_record.thumbnail = Thumbnail(data=data, width=width, height=height, source=source)
+            file_record.has_thumbnail = True
+            db.session.commit()
+            return True
+
+    def _find_original(self, sha256, db_file_id):
+        if not self.app:
+            return None
+        from database import File
+        with self.app.app_context():
+            original = File.find_uploaded(sha256, exclude_id=db_file_id)
+            # A single message can't stand in for a chunked copy (STORAGE_CHUNK_SIZE changed since)
+            if not original or original.chunk_count:
+                return None
+            return original.telegram_id, original.chat_id, original.codec
+
+    def _get_upload_pool(self, target):
+        if target.account not in self.upload_pools:
+            self.upload_pools[target.account] = SenderPool(target.client, max(1, Config.UPLOAD_WORKERS))
+        return self.upload_pools[target.account]
+
+    def _get_download_pool(self, target, dc_id):
+        key = (target.account, dc_id)
+        if key not in self.download_pools:
+            self.download_pools[key] = SenderPool(target.client, Config.DOWNLOAD_WORKERS, dc_id=dc_id)
+        return self.download_pools[key]
+
+    async def _handle_download(self, request_id, args):
+        # Feeds the caller's bounded buffer: the real size first, then the
+        # chunks, then None. Errors are handed over too so the reader stops.
+        started = time.perf_counter()
+        sent = 0
+        try:
+            if args.get('chunk_map'):
+                sent = await self._download_chunks(args)
+            else:
+                target = self._target_for(args.get('chat_id'))
+                message = await self._get_message(target, args['msg_id'])
+                await self._hand_over(args, message.file.size)
+
+                size = message.file.size
+                offset, length = args['offset'], args['length']
+                if length is None:
+                    length = max(size - offset, 0)
+                async for chunk in self._iter_message(target, message, offset, length):
+                    await self._hand_over(args, chunk)
+                    sent += len(chunk)
+        except Exception as e:
+            await self._hand_over(args, e)
+            raise
+        await self._hand_over(args, None)
+        self._record_transfer('download', sent, started)
+
+    async def _hand_over(self, args, item):
+        """Puts `item` in a download's buffer for the web thread reading it.
+
+        A reader that fell behind (a paused video, a slow client) doesn't
+        keep the download slot meanwhile: it is lent out until there is
+        room again. The download sends Telegram no new requests while the
+        slot is lent; only those already in flight finish.
+        """
+        buffer = args['buffer']
+        if buffer.full():
+            async with args['slot'].lent():
+                await buffer.put(item)
+        else:
+            buffer.put_nowait(item)
+
+    async def _download_chunks(self, args):
+        """Streams a byte range of a chunked file from the chunks it spans.
+
+        Up to STORAGE_CHUNK_READ_AHEAD chunks are read at once, each into its
+        own small queue, and passed on in order. Chunks read whole are
+        checked against their sha256. Returns the number of bytes passed on.
+        """
+        chunk_map = args['chunk_map']
+        size = sum(chunk['size'] for chunk in chunk_map)
+        await self._hand_over(args, size)
+
+        offset, length = args['offset'], args['length']
+        end = size if length is None else min(offset + length, size)
+        spans = []
+        start = 0
+        for chunk in chunk_map:
+            stop = start + chunk['size']
+            if start < end and stop > offset:
+                first = max(offset, start) - start
+                spans.append((chunk, first, min(end, stop) - start - first))
+            start = stop
+
+        async def read(chunk, first, length, queue):
+            try:
+                target = self._target_for(chunk['chat_id'])
+                message = await self._get_message(target, chunk['telegram_id'])
+                async for data in self._iter_message(target, message, first, length):
+                    await queue.put(data)
+                    # Read-ahead pauses while _hand_over has lent the slot out
+                    await args['slot'].wait_held()
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        waiting = iter(spans)
+        reading = collections.deque()
+        sent = 0
+        try:
+            for _ in spans:
+                for chunk, first, length in waiting:
+                    queue = asyncio.Queue(maxsize=Config.DOWNLOAD_BUFFER_CHUNKS)
+                    reading.append((chunk, length, queue, asyncio.ensure_future(read(chunk, first, length, queue))))
+                    if len(reading) >= max(1, Config.STORAGE_CHUNK_READ_AHEAD):
+                        break
+                chunk, length, queue, _ = reading.popleft()
+                digest = hashlib.sha256() if length == chunk['size'] and chunk.get('sha256') else None
+                while True:
+                    data = await queue.get()
+                    if data is None:
+                        break
+                    if isinstance(data, Exception):
+                        raise data
+                    if digest:
+                        digest.update(data)
+                    await self._hand_over(args, data)
+                    sent += len(data)
+                if digest and digest.hexdigest() != chunk['sha256']:
+                    raise Exception(f"Chunk {chunk['index']} (msg {chunk['telegram_id']}) does not match its checksum")
+        finally:
+            for *_, task in reading:
+                task.cancel()
+        return sent
+
+    async def _get_message(self, target, msg_id):
+        message = await target.client.get_messages(target.entity, ids=msg_id)
+        if not message or not message.media:
+            raise Exception("Message not found")
+        return message
+
+    async def _iter_message(self, target, message, offset, length):
+        """Yields `length` bytes of a message's media from `offset`."""
+        with target.track(length):
+            if Config.DOWNLOAD_WORKERS > 1 and length >= Config.PARALLEL_DOWNLOAD_THRESHOLD:
+                dc_id, location = media_location(message.media)
+                senders = await self._get_download_pool(target, dc_id).get()
+                downloader = ParallelDownloader(
+                    senders,
+                    chunk_size=Config.DOWNLOAD_CHUNK_SIZE,
+                    retries=Config.DOWNLOAD_CHUNK_RETRIES,
+                    log=self._log
+                )
+                chunks = downloader.iter_range(location, offset, length)
+            else:
+                chunks = self._iter_serial(target.client, message, offset, length)
+            async for chunk in chunks:
+                yield chunk
+
+    async def _iter_serial(self, client, message, offset, length):
+        # Telegram serves aligned chunks: start at the chunk holding
+        # `offset`, trim the head, and stop once `length` bytes went out.
+        chunk_size = Config.DOWNLOAD_CHUNK_SIZE
+        aligned = offset - offset % chunk_size
+        skip = offset - aligned
+        async for chunk in client.iter_download(message.media, offset=aligned, request_size=chunk_size):
+            if skip:
+                chunk, skip = chunk[skip:], 0
+            chunk = chunk[:length]
+            length -= len(chunk)
+            if chunk:
+                yield chunk
+            if length <= 0:
+                return
+
+    async def _handle_delete(self, request_id, args):
+        # Telegram takes at most 100 ids per call; FloodWait doesn't fail the batch
+        msg_ids = args['msg_ids']
+        target = self._target_for(args.get('chat_id'))
+        for start in range(0, len(msg_ids), Config.DELETE_BATCH_SIZE):
+            batch = msg_ids[start:start + Config.DELETE_BATCH_SIZE]
+            while True:
+                try:
+                    with metrics.RPC_SECONDS.time(method='delete_messages'):
+                        await target.client.delete_messages(target.entity, batch)
+                    break
+                except errors.FloodWaitError as e:
+                    metrics.FLOOD_WAITS.inc(method='delete_messages')
+                    metrics.FLOOD_WAIT_SECONDS.inc(e.seconds, method='delete_messages')
+                    self._log(f"[{request_id}] FloodWait {e.seconds}s deleting messages")
+                    await asyncio.sleep(e.seconds)
+        return len(msg_ids)
+
+    _handlers = {
+        'upload': _handle_upload,
+        'download': _handle_download,
+        'delete': _handle_delete,
+    }
+
+    def _submit(self, cmd, args):
+        """Schedules `cmd` on the event loop and returns a concurrent.futures.Future.
+
+        The future can be waited on with a timeout or cancelled, which also
+        cancels the command on the loop.
+        """
+        if cmd not in self._handlers:
+            raise ValueError(f"Unknown command: {cmd}")
+        if self.loop is None or self.loop.is_closed():
+            raise Exception("Telegram service is sleeping or not initialized. Check your credentials and connection.")
+        request_id = uuid.uuid4().hex[:12]
+        future = asyncio.run_coroutine_threadsafe(self._run_command(request_id, cmd, args), self.loop)
+        future.request_id = request_id
+        return future
+
+    def _wait_ready(self):
         # If the service isn't ready, wait up to 45 seconds (important for slow proxy connections)
         if not self.ready_event.is_set():
             self._log("Service not ready yet, waiting...")
             if not self.ready_event.wait(timeout=45):
                 raise Exception("Telegram service is sleeping or not initialized. Check your credentials and connection.")
-        
-        thread_id = threading.get_ident()
-        res_q = queue.Queue()
-        self.result_queues[thread_id] = res_q
+
+    def _step(self, coro, future, timeout):
+        """Runs `coro` on the loop on behalf of the running command `future`.
+
+        Used to hand data between a web thread and a streaming command. If
+        the command dies first its error is raised instead of waiting out
+        the timeout.
+        """
+        step = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        done, _ = concurrent.futures.wait([step, future], timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        if step in done:
+            return step.result()
+        if future in done:
+            if future.cancelled() or future.exception() is not None:
+                step.cancel()
+                future.result()
+            # The command finished; whatever it left behind is ready now
+            try:
+                return step.result(timeout=5)
+            except concurrent.futures.TimeoutError:
+                pass
+        step.cancel()
+        future.cancel()
+        raise Exception(f"Telegram transfer timed out after {timeout}s (request {future.request_id})")
+
+    def _send_request(self, cmd, args, timeout=300):
+        self._wait_ready()
+        future = self._submit(cmd, args)
         try:
-            self.request_queue.put((thread_id, cmd, args))
-            status, val = res_q.get(timeout=300)
-            if status == 'error': raise Exception(val)
-            return val
-        finally:
-            self.result_queues.pop(thread_id, None)
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise Exception(f"Telegram {cmd} timed out after {timeout}s (request {future.request_id})")
 
     def upload_file(self, path, task_id=None): # Sync version
         return self._send_request('upload', {'path': path, 'task_id': task_id})
 
     def submit_upload(self, path, db_file_id, task_id=None): # Async version
-        self.request_queue.put((f"async_{task_id}", 'upload', {
-            'path': path, 
-            'task_id': task_id, 
+        """Queues a staged file for upload. The job is stored in the database,
+        so it survives restarts and is retried on failure. Returns its id."""
+        job_id = self.jobs.enqueue(db_file_id, path, task_id)
+        self.wake_jobs()
+        return job_id
+
+    def wake_jobs(self):
+        """Makes the scheduler look for due jobs now rather than at its next poll."""
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._jobs_wakeup.set)
+
+    def upload_stream(self, stream, size, name, db_file_id, task_id=None, timeout=300):
+        """Uploads `size` bytes read from `stream` without staging them on disk.
+
+        Each part is forwarded to Telegram while the rest is still being
+        read; only a few parts per upload are ever buffered. Returns the
+        command's future once the whole body has been handed over; if the
+        upload fails after that, the `db_file_id` placeholder row and any
+        chunks of it already sent are deleted.
+        """
+        self._wait_ready()
+        parts = asyncio.Queue(maxsize=max(1, Config.UPLOAD_WORKERS) * 2)
+        args = {
+            'parts': parts,
+            'size': size,
+            'name': name,
+            'task_id': task_id,
             'db_file_id': db_file_id
-        }))
-        return True
+        }
+        future = self._submit('upload', args)
+        digest = hashlib.sha256()
+        try:
+            remaining = size
+            while remaining > 0:
+                part = read_exactly(stream, min(MAX_PART_SIZE, remaining))
+                if not part:
+                    raise Exception(f"Upload body ended {remaining} bytes early")
+                digest.update(part)
+                self._step(parts.put(part), future, timeout)
+                remaining -= len(part)
+            # Set before the end marker, so the handler sees it when the parts run out
+            args['sha256'] = digest.hexdigest()
+            self._step(parts.put(None), future, timeout)
+        except BaseException:
+            future.cancel()
+            raise
+        if self.app and db_file_id:
+            future.add_done_callback(lambda done: self._streamed_upload_done(done, db_file_id))
+        return future
 
-    def download_file_to_stream(self, msg_id, output):
-        return self._send_request('download', {'msg_id': int(msg_id), 'output': output})
+    def open_download(self, msg_id, offset=0, length=None, timeout=300, chat_id=None, chunk_map=None, wait=True):
+        """Starts streaming a message's media from Telegram.
 
-    def delete_messages(self, msg_ids):
+        Returns (size, chunks) where `size` is the full media size and
+        `chunks` yields `length` bytes from `offset` (or everything after it
+        when `length` is None) as they arrive. `chat_id` is the File row's,
+        picking the storage target the message lives in. For a chunked file
+        pass File.chunk_map() instead; only the chunks the range overlaps
+        are read.
+        With wait=False it returns at once with size None: the transfer is
+        queued all the same, and `chunks` waits for it when first read.
+        At most DOWNLOAD_BUFFER_CHUNKS chunks are held in memory; closing the
+        iterator, read from or not, cancels the transfer.
+        """
+        self._wait_ready()
+        buffer = asyncio.Queue(maxsize=Config.DOWNLOAD_BUFFER_CHUNKS)
+        future = self._submit('download', {
+            'msg_id': int(msg_id),
+            'chat_id': chat_id,
+            'offset': offset,
+            'length': length,
+            'chunk_map': chunk_map,
+            'buffer': buffer
+        })
+
+        def next_item():
+            item = self._step(buffer.get(), future, timeout)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        def chunks(size_read):
+            try:
+                yield # primed below, so close() always gets to the finally
+                if not size_read:
+                    next_item()
+                while True:
+                    item = next_item()
+                    if item is None:
+                        return
+                    yield item
+            finally:
+                future.cancel()
+
+        size = None
+        if wait:
+            try:
+                size = next_item()
+            except BaseException:
+                future.cancel()
+                raise
+        stream = chunks(size_read=wait)
+        next(stream)
+        return size, stream
+
+    def download_file_to_stream(self, msg_id, output, chat_id=None, chunk_map=None):
+        _, chunks = self.open_download(msg_id, chat_id=chat_id, chunk_map=chunk_map)
+        for chunk in chunks:
+            output.write(chunk)
+
+    def delete_messages(self, msg_ids, chat_id=None):
         # Ensure IDs are integers
         clean_ids = [int(mid) for mid in msg_ids if mid]
         if clean_ids:
-            return self._send_request('delete', {'msg_ids': clean_ids})
+            return self._send_request('delete', {'msg_ids': clean_ids, 'chat_id': chat_id})
         return True
 
+def read_exactly(stream, n):
+    """Reads up to `n` bytes, only returning short at the end of the stream."""
+    buf = bytearray()
+    while len(buf) < n:
+        data = stream.read(n - len(buf))
+        if not data:
+            break
+        buf += data
+    return bytes(buf)
+
+async def queued_parts(parts):
+    while True:
+        part = await parts.get()
+        if part is None:
+            return
+        yield part
+
+async def take(parts, count):
+    """Yields the next `count` items of the async iterator `parts`, leaving the rest."""
+    for _ in range(count):
+        try:
+            yield await parts.__anext__()
+        except StopAsyncIteration:
+            return
+
+async def hashed(parts, digest):
+    async for part in parts:
+        digest.update(part)
+        yield part
+
 telegram_service = TelegramService()
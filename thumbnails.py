@@ -0,0 +1,60 @@
+"""Small JPEG previews of uploaded files for the dashboard tiles.
+
+Images are scaled down from the staged upload when Pillow is installed.
+Everything else, and images without Pillow, gets the thumbnail Telegram
+made for the sent message, if it made one (photos and videos mostly).
+Either way it happens once, at upload time, and the result is stored
+as a Thumbnail row.
+"""
+import io
+
+from telethon.tl import types
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# The sizes Telegram lists that are actual images (not stripped, path or video sizes)
+TELEGRAM_SIZES = (types.PhotoSize, types.PhotoCachedSize, types.PhotoSizeProgressive)
+
+
+def from_image(path, size, quality=80):
+    """(jpeg_bytes, width, height) of the image at `path` fitted into size x size.
+
+    None without Pillow or if `path` isn't an image it can read.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            # JPEGs are decoded straight at a fraction of their size
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=quality, optimize=True)
+            return out.getvalue(), image.width, image.height
+    except Exception:
+        return None
+
+
+def telegram_thumbs(msg):
+    """The image thumbnails Telegram keeps for a sent message's media."""
+    if getattr(msg, 'photo', None):
+        thumbs = msg.photo.sizes
+    elif getattr(msg, 'document', None):
+        thumbs = msg.document.thumbs
+    else:
+        thumbs = None
+    return [thumb for thumb in thumbs or [] if isinstance(thumb, TELEGRAM_SIZES)]
+
+
+def pick(thumbs, size):
+    """The smallest of `thumbs` covering `size` on its longer side, else the largest."""
+    if not thumbs:
+        return None
+    thumbs = sorted(thumbs, key=lambda thumb: max(thumb.w, thumb.h))
+    return next((thumb for thumb in thumbs if max(thumb.w, thumb.h) >= size), thumbs[-1])
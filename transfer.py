@@ -0,0 +1,277 @@
+"""Part-level Telegram transfers spread over several MTProto connections.
+
+Telethon's own send_file/download_media move one part at a time over the
+client's single connection. The engines here keep several requests in
+flight on a pool of extra senders, which is where most of the throughput
+for large files comes from.
+"""
+import asyncio
+import collections
+import os
+import random
+
+from telethon import errors, functions, types, utils
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+
+import metrics
+
+# Telegram accepts parts up to 512 KiB; files above 10 MiB must use the
+# "big file" calls. GetFile limits must be multiples of 4 KiB dividing 1 MiB.
+MAX_PART_SIZE = 512 * 1024
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+MIN_CHUNK_SIZE = 4096
+
+
+class SenderPool:
+    """A fixed number of extra MTProtoSender connections to one DC.
+
+    The home DC reuses the session's auth key; other DCs get an exported
+    authorization, the same way Telethon builds its borrowed senders.
+    """
+
+    def __init__(self, client, size, dc_id=None):
+        self.client = client
+        self.size = size
+        self.dc_id = dc_id or client.session.dc_id
+        self.senders = []
+        self._lock = asyncio.Lock()
+
+    async def _connect_one(self):
+        client = self.client
+        dc = await client._get_dc(self.dc_id)
+        home = self.dc_id == client.session.dc_id
+        sender = MTProtoSender(client.session.auth_key if home else None, loggers=client._log)
+        await sender.connect(client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy,
+            local_addr=client._local_addr
+        ))
+        if not home:
+            auth = await client(functions.auth.ExportAuthorizationRequest(self.dc_id))
+            client._init_request.query = functions.auth.ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+            await sender.send(functions.InvokeWithLayerRequest(LAYER, client._init_request))
+        return sender
+
+    async def get(self):
+        """Returns the connected senders, opening them on first use."""
+        async with self._lock:
+            missing = self.size - len(self.senders)
+            if missing > 0:
+                self.senders += await asyncio.gather(*(self._connect_one() for _ in range(missing)))
+            return list(self.senders)
+
+    async def close(self):
+        async with self._lock:
+            senders, self.senders = self.senders, []
+        for sender in senders:
+            await sender.disconnect()
+
+
+async def _send_with_retry(sender, request, retries, log=None):
+    attempt = 0
+    method = type(request).__name__
+    while True:
+        try:
+            with metrics.RPC_SECONDS.time(method=method):
+                result = await sender.send(request)
+            if result is False:
+                raise Exception("Telegram rejected the request")
+            return result
+        except errors.FloodWaitError as e:
+            # Not the part's fault: wait it out without spending a retry
+            metrics.FLOOD_WAITS.inc(method=method)
+            metrics.FLOOD_WAIT_SECONDS.inc(e.seconds, method=method)
+            if log:
+                log(f"FloodWait {e.seconds}s on {type(request).__name__}")
+            await asyncio.sleep(e.seconds)
+        except Exception:
+            attempt += 1
+            if attempt > retries:
+                raise
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 8))
+
+
+def new_file_id():
+    """A random id for the parts of one upload."""
+    return random.randrange(-2 ** 63, 2 ** 63)
+
+
+async def file_parts(path, part_size=MAX_PART_SIZE, first_part=0, count=None):
+    """Yields the contents of `path` in `part_size` pieces, from part `first_part` on.
+
+    Stops after `count` parts if given.
+    """
+    with open(path, 'rb') as f:
+        f.seek(first_part * part_size)
+        while count is None or count > 0:
+            part = f.read(part_size)
+            if not part:
+                return
+            yield part
+            if count is not None:
+                count -= 1
+
+
+class ParallelUploader:
+    """Uploads one file as Telegram parts over several senders at once.
+
+    `parts` is an async iterator of bytes, each exactly `part_size` long
+    except the last. The result is an InputFile/InputFileBig that can be
+    passed to client.send_file.
+
+    An interrupted upload can be resumed by passing the same `file_id` and
+    the first part Telegram has not acknowledged as `first_part`; `parts`
+    then starts at that part. `on_part(index)` is called as each part is
+    acknowledged, in no particular order.
+    """
+
+    def __init__(self, senders, part_size=MAX_PART_SIZE, retries=3, log=None):
+        if part_size > MAX_PART_SIZE or MAX_PART_SIZE % part_size:
+            raise ValueError("part_size must evenly divide 512 KiB")
+        self.senders = senders
+        self.part_size = part_size
+        self.retries = retries
+        self.log = log
+
+    async def upload(self, parts, size, name, progress_callback=None, file_id=None, first_part=0, on_part=None):
+        is_big = size > BIG_FILE_THRESHOLD
+        total_parts = max(1, (size + self.part_size - 1) // self.part_size)
+        if file_id is None:
+            file_id = new_file_id()
+
+        # Bounded so at most ~2 parts per sender sit in memory at once
+        pending = asyncio.Queue(maxsize=len(self.senders) * 2)
+        uploaded = min(first_part * self.part_size, size)
+
+        async def produce():
+            index = first_part
+            async for part in parts:
+                await pending.put((index, part))
+                index += 1
+            if index != total_parts:
+                raise Exception(f"Expected {total_parts} parts for {size} bytes, got {index}")
+            for _ in self.senders:
+                await pending.put(None)
+
+        async def consume(sender):
+            nonlocal uploaded
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                index, part = item
+                if is_big:
+                    request = functions.upload.SaveBigFilePartRequest(file_id, index, total_parts, part)
+                else:
+                    request = functions.upload.SaveFilePartRequest(file_id, index, part)
+                await _send_with_retry(sender, request, self.retries, self.log)
+                uploaded += len(part)
+                if on_part:
+                    on_part(index)
+                if progress_callback:
+                    progress_callback(uploaded, size)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(consume(sender)) for sender in self.senders]
+        try:
+            # Any failing task (a part out of retries, a short read) aborts the rest
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if is_big:
+            return types.InputFileBig(file_id, total_parts, name)
+        return types.InputFile(file_id, total_parts, name, '')
+
+    async def upload_file(self, path, progress_callback=None, file_id=None, first_part=0, on_part=None):
+        return await self.upload(
+            file_parts(path, self.part_size, first_part),
+            os.path.getsize(path),
+            os.path.basename(path),
+            progress_callback=progress_callback,
+            file_id=file_id,
+            first_part=first_part,
+            on_part=on_part
+        )
+
+
+def media_location(media):
+    """Returns (dc_id, InputFileLocation) for a message's document or photo."""
+    dc_id, location, _ = utils._get_file_info(media)
+    return dc_id, location
+
+
+class ParallelDownloader:
+    """Downloads one file with several GetFile requests in flight at once.
+
+    Requests for consecutive chunks are spread round-robin over `senders`
+    and yielded strictly in order. At most `window` chunks are fetched
+    ahead of the consumer, which bounds memory per download.
+    """
+
+    def __init__(self, senders, chunk_size=MAX_PART_SIZE, retries=3, window=None, log=None):
+        if chunk_size % MIN_CHUNK_SIZE or (1024 * 1024) % chunk_size:
+            raise ValueError("chunk_size must be a multiple of 4 KiB that divides 1 MiB")
+        self.senders = senders
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.window = window or len(senders) * 2
+        self.log = log
+
+    async def _fetch(self, sender, location, offset):
+        request = functions.upload.GetFileRequest(location, offset=offset, limit=self.chunk_size)
+        result = await _send_with_retry(sender, request, self.retries, self.log)
+        if getattr(result, 'bytes', None) is None:
+            raise Exception(f"Unexpected GetFile result: {type(result).__name__}")
+        return result.bytes
+
+    async def iter_range(self, location, offset, length):
+        """Yields exactly `length` bytes of the file starting at `offset`."""
+        if length <= 0:
+            return
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        skip = offset - first * self.chunk_size
+        remaining = length
+
+        in_flight = collections.deque()
+        next_index = first
+        try:
+            while remaining > 0:
+                while next_index <= last and len(in_flight) < self.window:
+                    sender = self.senders[next_index % len(self.senders)]
+                    in_flight.append(asyncio.ensure_future(
+                        self._fetch(sender, location, next_index * self.chunk_size)))
+                    next_index += 1
+                if not in_flight:
+                    return
+                chunk = await in_flight.popleft()
+                if skip:
+                    chunk, skip = chunk[skip:], 0
+                chunk = chunk[:remaining]
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def download_to(self, location, size, output, progress_callback=None):
+        """Writes the whole file to the file-like `output`."""
+        written = 0
+        async for chunk in self.iter_range(location, 0, size):
+            output.write(chunk)
+            written += len(chunk)
+            if progress_callback:
+                progress_callback(written, size)
+        return written
@@ -0,0 +1,151 @@
+"""ZIP archives streamed as they are written, for folder downloads.
+
+Entries are stored uncompressed, with ZIP64 records wherever sizes or
+offsets need them, and CRCs and sizes in data descriptors after each
+file. So nothing has to be known up front or seeked back to, and only
+the chunk being written is held in memory.
+"""
+import collections
+import itertools
+import zipfile
+from datetime import datetime
+
+CHUNK_SIZE = 512 * 1024
+
+
+class ZipEntry:
+    """A file or, with `open` None, a directory to put in the archive.
+
+    `open()` starts fetching the content and returns an iterator of its
+    bytes; stream_zip calls it a few entries ahead of writing, so it should
+    only wait for the content once iterated. The iterator is close()d when
+    done with, whether it was read or not.
+    """
+
+    def __init__(self, name, size=0, modified=None, open=None):
+        self.name = name
+        self.size = size
+        self.modified = modified
+        self.open = open
+
+    @property
+    def is_dir(self):
+        return self.open is None
+
+
+class _Sink:
+    """Write-only file for ZipFile that keeps bytes only until take()n.
+
+    Having no seek() makes ZipFile write data descriptors.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def read_file(path, chunk_size=CHUNK_SIZE):
+    """Opens `path` now and returns an iterator of its contents."""
+    f = open(path, 'rb')
+
+    def chunks():
+        with f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+    return chunks()
+
+
+def _info(name, modified=None, size=0, is_dir=False):
+    modified = modified or datetime.utcnow()
+    date_time = max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)) # DOS dates start in 1980
+    info = zipfile.ZipInfo(name + '/' if is_dir else name, date_time)
+    info.compress_type = zipfile.ZIP_STORED
+    if is_dir:
+        info.external_attr = (0o40755 << 16) | 0x10
+    else:
+        info.external_attr = 0o644 << 16
+        # Only used to decide on ZIP64 before the first byte goes out
+        info.file_size = size or 0
+    return info
+
+
+def stream_zip(entries, prefetch=2, log=None):
+    """Yields the bytes of a ZIP archive of `entries` (ZipEntry objects).
+
+    Up to `prefetch` files after the one being written are already
+    open()ed, so their transfers run meanwhile. Files that fail to open or
+    to give their first chunk are left out and listed in a trailing
+    ERRORS.txt; a failure later in a file ends the stream, as its bytes
+    can't be taken back.
+    """
+    entries = iter(entries)
+    ahead = collections.deque()
+    current = None
+    errors = []
+
+    def leave_out(entry, e):
+        if log:
+            log(f"Leaving {entry.name} out of the archive: {e}")
+        errors.append(f"{entry.name}: {e}")
+
+    def fill(files):
+        while sum(1 for entry, _ in ahead if not entry.is_dir) < files:
+            entry = next(entries, None)
+            if entry is None:
+                return
+            content = None
+            if not entry.is_dir:
+                try:
+                    content = entry.open()
+                except Exception as e:
+                    leave_out(entry, e)
+                    continue
+            ahead.append((entry, content))
+
+    sink = _Sink()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            while True:
+                fill(1)
+                if not ahead:
+                    break
+                entry, current = ahead.popleft()
+                fill(prefetch)
+                if entry.is_dir:
+                    archive.writestr(_info(entry.name, entry.modified, is_dir=True), b'')
+                else:
+                    try:
+                        first = next(current, b'')
+                    except Exception as e:
+                        leave_out(entry, e)
+                        continue
+                    with archive.open(_info(entry.name, entry.modified, entry.size), 'w') as out:
+                        for chunk in itertools.chain([first], current):
+                            out.write(chunk)
+                            yield sink.take()
+                yield sink.take()
+            current = None
+            if errors:
+                archive.writestr(_info('ERRORS.txt'), '\n'.join(errors) + '\n')
+        yield sink.take() # the central directory
+    finally:
+        # Stops the transfers of whatever was started but not written out
+        for content in [current] + [content for _, content in ahead]:
+            close = getattr(content, 'close', None)
+            if close:
+                close()